@@ -0,0 +1,231 @@
+#!/usr/bin/python
+# coding: U8
+
+"""Profiler overhead and report scalability benchmarks.
+
+    python benchmarks/bench_pprofiler.py --output new.json
+    python benchmarks/bench_pprofiler.py --output new.json --compare old.json
+"""
+
+
+import argparse
+import collections
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pprofiler  # noqa: E402
+
+
+def best_ns(f, number, repeat):
+    r = None
+    for _ in range(repeat):
+        t = time.perf_counter_ns()
+        f(number)
+        t = (time.perf_counter_ns() - t) / number
+        if r is None or t < r:
+            r = t
+    return r
+
+
+def bench_empty(number):
+    for _ in range(number):
+        pass
+
+
+def bench_context_manager(number):
+    p = pprofiler.Profiler()
+    t = p('x')
+    for _ in range(number):
+        with t:
+            pass
+
+
+def bench_context_manager_new_timer(number):
+    p = pprofiler.Profiler()
+    for _ in range(number):
+        with p('x'):
+            pass
+
+
+def bench_decorator(number):
+    p = pprofiler.Profiler()
+
+    @p('x')
+    def f():
+        pass
+
+    for _ in range(number):
+        f()
+
+
+def bench_plain_call(number):
+    def f():
+        pass
+
+    for _ in range(number):
+        f()
+
+
+def bench_deep(depth):
+    def bench(number):
+        p = pprofiler.Profiler()
+        timers = [p('level %d' % i) for i in range(depth)]
+        for _ in range(number // depth):
+            for t in timers:
+                t.__enter__()
+            for t in timers:
+                t.__exit__(None, None, None)
+    return bench
+
+
+def bench_siblings(names):
+    def bench(number):
+        p = pprofiler.Profiler()
+        timers = [p('name %d' % i) for i in range(names)]
+        for _ in range(number // names):
+            for t in timers:
+                with t:
+                    pass
+    return bench
+
+
+def bench_thread_profiler(number):
+    p = pprofiler.ThreadProfiler()
+    t = p('x')
+    for _ in range(number):
+        with t:
+            pass
+
+
+def bench_percentiles(number):
+    p = pprofiler.Profiler(percentiles=True)
+    t = p('x')
+    for _ in range(number):
+        with t:
+            pass
+
+
+def bench_sampling(number):
+    p = pprofiler.Profiler(sample=100)
+    t = p('x')
+    for _ in range(number):
+        with t:
+            pass
+
+
+def build_tree(nodes, fanout=10):
+    """Profiler with `nodes` scopes, `fanout` children per scope, filled in breadth first order."""
+    p = pprofiler.Profiler()
+    queue = collections.deque([p.root])
+    created = 0
+    while created < nodes:
+        parent = queue.popleft()
+        for i in range(min(fanout, nodes - created)):
+            scope = parent.scopes[str(i)] = p.new_scope()
+            for v in (1000 + created % 7, 2000 + created % 13):
+                scope.stat.update(v)
+            queue.append(scope)
+            created += 1
+    return p
+
+
+def memory_per_scope(nodes):
+    tracemalloc.start()
+    p = build_tree(nodes)
+    before = tracemalloc.get_traced_memory()[0]
+    del p
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (before - after) / nodes
+
+
+def time_s(f, repeat):
+    r = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        t = time.perf_counter() - t
+        if r is None or t < r:
+            r = t
+    return r
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='save results into JSON file')
+    parser.add_argument('--compare', help='compare with results saved before')
+    parser.add_argument('--number', type=int, default=100000, help='enter/exit pairs per round')
+    parser.add_argument('--repeat', type=int, default=5, help='rounds, the best one is taken')
+    parser.add_argument('--max-nodes', type=int, default=10 ** 6, help='the largest tree for report benchmarks')
+    args = parser.parse_args()
+
+    results = collections.OrderedDict()
+    overhead = collections.OrderedDict()
+    empty = best_ns(bench_empty, args.number, args.repeat)
+    for name, f in [
+        ('plain call', bench_plain_call),
+        ('context manager', bench_context_manager),
+        ('context manager, new timer', bench_context_manager_new_timer),
+        ('decorator', bench_decorator),
+        ('depth 10', bench_deep(10)),
+        ('depth 100', bench_deep(100)),
+        ('1000 siblings', bench_siblings(1000)),
+        ('thread profiler', bench_thread_profiler),
+        ('percentiles', bench_percentiles),
+        ('sampling 1/100', bench_sampling),
+    ]:
+        overhead[name] = best_ns(f, args.number, args.repeat) - empty
+        print('{:.<40s} {:10.0f} ns per enter/exit'.format(name + ' ', overhead[name]))
+    results['enter/exit ns'] = overhead
+
+    memory = collections.OrderedDict()
+    memory['scope'] = memory_per_scope(10000)
+    print('{:.<40s} {:10.0f} bytes'.format('memory per scope ', memory['scope']))
+    results['memory per scope bytes'] = memory
+
+    reports = collections.OrderedDict()
+    nodes = 1000
+    while nodes <= args.max_nodes:
+        p = build_tree(nodes)
+        repeat = max(1, args.repeat * 1000 // nodes)
+        for name, f in [
+            ('report', lambda: p.report),
+            ('iter', lambda: list(p)),
+            ('lines', lambda: list(p.lines)),
+        ]:
+            key = '{} {}'.format(name, nodes)
+            reports[key] = time_s(f, repeat)
+            print('{:.<40s} {:10.3f} s'.format(key + ' ', reports[key]))
+        nodes *= 10
+    results['report s'] = reports
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+        print('== compared with {} (new/old)'.format(args.compare))
+        for group, values in results.items():
+            for k, v in values.items():
+                o = old.get(group, {}).get(k)
+                if o:
+                    print('{:.<40s} {:10.2f}'.format('{} {} '.format(group, k), v / o))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(collections.OrderedDict([
+                ('version', pprofiler.__version__),
+                ('python', platform.python_version()),
+                ('implementation', platform.python_implementation()),
+                ('machine', platform.machine()),
+                ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                ('results', results),
+            ]), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -43,6 +43,8 @@ def main():
     profiler.print_report(logger.info)
     for r in workers_reports:
         r.print_report(logger.info)
+    logger.info('== Merged workers report:')
+    type(profiler)().merge(*workers_reports).print_report(logger.info)
     logger.info('== Simple custom report:')
     for r in itertools.chain.from_iterable(x.report for x in [profiler] + workers_reports):
         logger.info('{name:.<20s} {sum:.3f} seconds'.format(**r))
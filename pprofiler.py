@@ -1,43 +1,298 @@
 # coding: U8
 
 
-from __future__ import print_function
-
 import collections
+import contextvars
+import csv
 import functools
+import heapq
+import inspect
+import itertools
+import json
+import argparse
+import array
+import struct
+import sys
+import threading
 import time
+import traceback
 import math
+import multiprocessing
+import multiprocessing.shared_memory
+import os
+import random
+import socket
+import sqlite3
+import tracemalloc
+import uuid
 
 
-__all__ = ['profiler']  # the only publick symbol
+__all__ = [
+    'profiler',
+    'ThreadProfiler',
+    'AsyncProfiler',
+    'OpenMetricsExporter',
+    'SQLiteSink',
+    'CSVSink',
+    'JSONLinesSink',
+    'SharedStats',
+    'DeltaSender',
+    'Collector',
+]  # publick symbols
 __version__ = '2.0.1'
 
 
 SUBSCOPE_NAME = '~'
 
 
-Scope = collections.namedtuple('Scope', ('stat', 'scopes'))
+TICKS_PER_SECOND = 1e9  # profilers measure time by time.perf_counter_ns()
+CALIBRATION_SCOPE = '<calibration>'
+UNACCOUNTED_SCOPE = '<unaccounted>'
+OTHER_SCOPE = '<other>'
+OTHER_LABELS = (('labels', OTHER_SCOPE),)  # labels of a scope over the limits
+MAX_INTERNED = 10000  # labels interned by a profiler, other labels are not cached
+RESERVED_LABELS = ('scope', 'le')  # label names of OpenMetricsExporter
+EXEMPLAR_STACK = 8  # frames of captured stacks
 
 
-std_print = print  # just to easy testing with Python2
+PERCENTILES = (('p50', .5), ('p90', .9), ('p99', .99), ('p999', .999))
+CLOCKS = (('cpu', 'process_time_ns'), ('thread', 'thread_time_ns'))  # extra clocks: name, function of time module
+MEMORY = ('alloc', 'peak')  # bytes left allocated by a scope, growth of traced memory peak in a scope
+SCALED_FIELDS = ('sum', 'avg', 'dev', 'min', 'max') + tuple(k for k, _ in PERCENTILES) + tuple(k for k, _ in CLOCKS)
 
 
-class Stat(object):
+DUMP_MAGIC = b'PPRF'
+DUMP_VERSION = 6
+DUMP_HEADER = struct.Struct('<4sBIIII')  # magic, version, number of names, number of nodes, number of clocks, number of labels
+DUMP_NAME_LENGTH = struct.Struct('<I')
+DUMP_NODE = struct.Struct('<iIQqdqqQHBI')  # parent node (-1 for top level), name, n, sum, sum2, min, max, skipped, histogram buckets, clocks, labels
+DUMP_CLOCK = struct.Struct('<IQqdqq')  # clock name, n, sum, sum2, min, max
+DUMP_LABEL = struct.Struct('<IQqdqqQ')  # labels as a name (JSON), n, sum, sum2, min, max, skipped
+DUMP_BUCKET = struct.Struct('<HQ')  # histogram bucket, count
+
+
+SHARED_MAGIC = b'PPRS'
+SHARED_VERSION = 1
+SHARED_HEADER = struct.Struct('<4sBxxxII')  # magic, version, workers, slots
+SHARED_COUNTERS = struct.Struct('<II')  # registered scopes, claimed workers; they follow the header
+SHARED_NAME_SIZE = 122  # longer names are truncated
+SHARED_NAME = struct.Struct('<iH{:d}s'.format(SHARED_NAME_SIZE))  # parent slot (-1 for top level), length of name, UTF-8 name
+SHARED_SEQUENCE = struct.Struct('<Q')  # odd while the stat is written
+SHARED_STAT = struct.Struct('<QqdqqQ')  # n, sum, sum2, min, max, skipped; a slot is the sequence and the stat
+SHARED_RETRIES = 1000  # reads of a stat that is being written
+
+
+std_print = print  # the default printer of print_report(), tests replace it
+
+
+class Histogram(object):
+    """HDR-like log-bucketed histogram with fixed memory.
+
+    Every power of two in [2**LOW, 2**HIGH) is split into SUBBUCKETS linear
+    buckets, so a quantile is within ~3% of the true value. Smaller and larger
+    values are counted in the first and the last bucket.
+    """
+
+    LOW = 0  # 1ns
+    HIGH = 50  # ~13 days
+    SUBBUCKETS = 16
 
     def __init__(self):
-        self.sum = self.sum2 = 0.
+        self.counts = array.array('Q', bytes(8 * (self.HIGH - self.LOW) * self.SUBBUCKETS))
+
+    def update(self, val):
+        m, e = math.frexp(val)  # val = m * 2**e, .5 <= m < 1
+        if e <= self.LOW:
+            i = 0
+        elif e > self.HIGH:
+            i = len(self.counts) - 1
+        else:
+            i = (e - self.LOW - 1) * self.SUBBUCKETS + int((m - .5) * 2 * self.SUBBUCKETS)
+        self.counts[i] += 1
+
+    def merge(self, other):
+        for i, c in enumerate(other.counts):
+            if c:
+                self.counts[i] += c
+        return self
+
+    def subtract(self, other):
+        for i, c in enumerate(other.counts):
+            if c:
+                self.counts[i] -= c
+        return self
+
+    def cumulative(self, edges):
+        """Numbers of values below 2**e for every e of ascending `edges`."""
+        r = []
+        acc = 0
+        i = 0
+        for e in edges:
+            end = min(max(0, e - self.LOW) * self.SUBBUCKETS, len(self.counts))
+            acc += sum(self.counts[i:end])
+            i = max(i, end)
+            r.append(acc)
+        return r
+
+    def quantile(self, q):
+        total = sum(self.counts)
+        if total == 0:
+            return None
+        rank = max(1, int(math.ceil(q * total)))
+        for i, c in enumerate(self.counts):
+            rank -= c
+            if rank <= 0:
+                break
+        e, sub = divmod(i, self.SUBBUCKETS)
+        return math.ldexp(.5 + (sub + .5) / (2 * self.SUBBUCKETS), e + self.LOW + 1)  # middle of bucket
+
+
+class Scope(object):
+
+    __slots__ = ('stat', 'scopes', 'labels')
+
+    def __init__(self, stat, scopes, labels=None):
+        self.stat = stat
+        self.scopes = scopes
+        self.labels = labels  # labels tuple: Scope with LabelStat and the same nested scopes
+
+
+class LabelStat(object):
+    """Stat of labeled entries of a scope; it updates the stat of the scope too.
+
+    The stat of the scope is looked up on every update, so the scope stat
+    can be swapped.
+    """
+
+    __slots__ = ('scope', 'stat')
+
+    def __init__(self, scope, stat):
+        self.scope = scope
+        self.stat = stat
+
+    def update(self, val):
+        self.scope.stat.update(val)
+        self.stat.update(val)
+
+    def update_clocks(self, val, vals):
+        self.scope.stat.update_clocks(val, vals)
+        self.stat.update_clocks(val, vals)
+
+    def skip(self):
+        self.scope.stat.skip()
+        self.stat.skip()
+
+    def is_sampled(self, rate):
+        return self.stat.is_sampled(rate)
+
+
+class Stat(object):
+
+    __slots__ = ('sum', 'sum2', 'min', 'max', 'n', 'skipped', 'histogram', 'clocks', 'exemplars')
+
+    def __init__(self, histogram=False, clocks=(), exemplars=None):
+        self.sum = self.sum2 = 0
         self.min = self.max = None
         self.n = 0
+        self.skipped = 0  # entries not measured by sampling
+        self.histogram = Histogram() if histogram else None
+        self.clocks = {k: Stat() for k in clocks} if clocks else None  # stats of extra clocks and MEMORY by name
+        self.exemplars = exemplars
 
     def update(self, val):
         if self.n == 0:
-            self.min = self.max = float(val)
-        else:
-            self.min = min(self.min, val)
-            self.max = max(self.max, val)
+            self.min = self.max = val
+        elif val < self.min:
+            self.min = val
+        elif val > self.max:
+            self.max = val
         self.sum += val
         self.sum2 += val * val
         self.n += 1
+        if self.histogram is not None:
+            self.histogram.update(val)
+        if self.exemplars is not None and val > self.exemplars.bar:
+            self.exemplars.capture(val)
+
+    def update_clocks(self, val, vals):
+        self.update(val)
+        for s, v in zip(self.clocks.values(), vals):
+            s.update(v)
+
+    def clock(self, name):
+        if self.clocks is None:
+            self.clocks = {}
+        s = self.clocks.get(name)
+        if s is None:
+            s = self.clocks[name] = Stat()
+        return s
+
+    def merge(self, other):
+        if other.histogram is not None:
+            if self.histogram is None:
+                self.histogram = Histogram()
+            self.histogram.merge(other.histogram)
+        if other.clocks is not None:
+            for k, v in other.clocks.items():
+                self.clock(k).merge(v)
+        if other.exemplars is not None:
+            if self.exemplars is None:
+                self.exemplars = Exemplars(other.exemplars.size, other.exemplars.threshold)
+            self.exemplars.merge(other.exemplars)
+        return self.merge_values(other.n, other.sum, other.sum2, other.min, other.max, other.skipped)
+
+    def __sub__(self, other):
+        """Stat of entries that came after `other`, an earlier state of this stat.
+
+        min/max of the result are bounds: they are exact only if the extreme
+        value came after `other`.
+        """
+        r = Stat().merge(self)
+        if r.histogram is not None and other.histogram is not None:
+            r.histogram.subtract(other.histogram)
+        if r.clocks is not None and other.clocks is not None:
+            for k, v in other.clocks.items():
+                if k in r.clocks:
+                    r.clocks[k] = r.clocks[k] - v
+        r.n -= other.n
+        r.skipped -= other.skipped
+        if r.n > 0:
+            r.sum -= other.sum
+            r.sum2 -= other.sum2
+        else:
+            r.sum = r.sum2 = 0
+            r.min = r.max = None
+        return r
+
+    def merge_values(self, n, s, s2, lo, hi, skipped=0):
+        self.skipped += skipped
+        if n > 0:
+            if self.n == 0:
+                self.min = lo
+                self.max = hi
+            else:
+                self.min = min(self.min, lo)
+                self.max = max(self.max, hi)
+            self.sum += s
+            self.sum2 += s2  # raw second moments just add up, it is the parallel variance formula
+            self.n += n
+        return self
+
+    def __add__(self, other):
+        return Stat().merge(self).merge(other)
+
+    def skip(self):
+        self.skipped += 1
+
+    def is_sampled(self, rate):
+        if rate >= 1:
+            return (self.n + self.skipped) % rate == 0
+        return random.random() < rate
+
+    def quantile(self, q):
+        if self.n == 0 or self.histogram is None:
+            return None
+        return min(max(self.histogram.quantile(q), self.min), self.max)
 
     @property
     def stat(self):
@@ -45,11 +300,9 @@ class Stat(object):
         if self.n > 0:
             avg = self.sum / self.n
         if self.n > 1:
-            dev = math.sqrt(
-                (self.sum2 - self.sum * self.sum / self.n) /
-                (self.n - 1)
-            )
-        return {
+            variance = (self.sum2 - self.sum * self.sum / self.n) / (self.n - 1)
+            dev = math.sqrt(max(0, variance))  # rounding of floats can make zero a tiny negative
+        r = {
             'sum': self.sum,
             'num': self.n,
             'avg': avg,
@@ -57,19 +310,161 @@ class Stat(object):
             'min': self.min,
             'max': self.max,
         }
+        if self.clocks is not None:
+            for k, c in self.clocks.items():
+                r[k] = c.max if k == 'peak' else c.sum
+                if k not in MEMORY:
+                    r[k + '%'] = 100 * c.sum / self.sum if self.sum > 0 else None  # utilisation, the rest is waiting
+        if self.skipped > 0:  # sum and num are scaled to all entries, other figures come from the sample
+            r['num'] = self.n + self.skipped
+            if self.n > 0:
+                r['sum'] = self.sum * r['num'] / self.n
+                if self.clocks is not None:
+                    for k in self.clocks:
+                        if k != 'peak':
+                            r[k] = r[k] * r['num'] / self.n
+            r['estimated'] = True
+        if self.histogram is not None:
+            for k, q in PERCENTILES:
+                r[k] = self.quantile(q)
+        return r
 
     def __repr__(self):
         return '<{}({})>'.format(type(self).__name__, ', '.join('{}={!r}'.format(k, self.stat[k]) for k in sorted(self.stat.keys())))
 
 
+class Exemplars(object):
+    """The slowest entries of a scope in a fixed-size heap.
+
+    An entry is captured if it is longer than `threshold` and, when the heap
+    is full, longer than the shortest captured one; `bar` is the only thing
+    the fast path compares with. Captured are duration, time, thread and
+    the result of `context()` or a truncated stack.
+    """
+
+    __slots__ = ('size', 'threshold', 'context', 'heap', 'bar')
+
+    def __init__(self, size, threshold=0, context=None):
+        self.size = size
+        self.threshold = threshold
+        self.context = context
+        self.heap = []  # (duration, sequence number, time, thread, context)
+        self.bar = threshold
+
+    def capture(self, val):
+        context = capture_stack() if self.context is None else self.context()
+        self.push((val, next(EXEMPLAR_SEQUENCE), time.time(), threading.get_ident(), context))
+
+    def push(self, item):
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, item)
+        else:
+            heapq.heapreplace(self.heap, item)
+        if len(self.heap) == self.size:
+            self.bar = max(self.threshold, self.heap[0][0])
+
+    def merge(self, other):
+        for item in other.heap:
+            if item[0] > self.bar:
+                self.push(item)
+
+
+class WindowStat(Stat):
+    """Stat that also keeps stats of recent intervals in a ring of buckets.
+
+    Every bucket is a plain Stat of one interval of `seconds`; memory is fixed,
+    update is O(1).
+    """
+
+    __slots__ = ('interval', 'buckets', 'epochs')
+
+    def __init__(self, seconds, buckets, histogram=False, clocks=(), exemplars=None):
+        super(WindowStat, self).__init__(histogram, clocks, exemplars)
+        self.interval = int(seconds * TICKS_PER_SECOND)
+        self.buckets = [Stat(clocks=clocks) for _ in range(buckets)]
+        self.epochs = [None] * buckets  # interval number of every bucket
+
+    def bucket(self):
+        epoch = time.perf_counter_ns() // self.interval
+        i = epoch % len(self.buckets)
+        b = self.buckets[i]
+        if self.epochs[i] != epoch:
+            self.epochs[i] = epoch
+            b.__init__(clocks=self.clocks or ())
+        return b
+
+    def update(self, val):
+        super(WindowStat, self).update(val)
+        self.bucket().update(val)
+
+    def update_clocks(self, val, vals):
+        super(WindowStat, self).update_clocks(val, vals)  # wall time of the bucket is updated by update()
+        for s, v in zip(self.bucket().clocks.values(), vals):
+            s.update(v)
+
+    def skip(self):
+        self.skipped += 1
+        self.bucket().skipped += 1
+
+    def window(self, seconds, now):
+        """Stat of the last `seconds`, rounded up to whole intervals, but no more than all buckets."""
+        last = now // self.interval
+        first = last - min(len(self.buckets), int(math.ceil(seconds * TICKS_PER_SECOND / self.interval)))
+        r = Stat()
+        for e, b in zip(self.epochs, self.buckets):
+            if e is not None and first < e <= last:
+                r.merge(b)
+        return r
+
+
+class SharedStat(Stat):
+    """Stat that is written through to a slot of SharedStats on every update.
+
+    A slot has the only writer. Its sequence number is odd while the slot is
+    written, so readers retry instead of taking torn values.
+    """
+
+    __slots__ = ('buf', 'offset', 'sequence')
+
+    def __init__(self, buf, offset):
+        super(SharedStat, self).__init__()
+        self.buf = buf
+        self.offset = offset
+        self.sequence = 0
+
+    def update(self, val):
+        super(SharedStat, self).update(val)
+        self.publish()
+
+    def skip(self):
+        self.skipped += 1
+        self.publish()
+
+    def publish(self):
+        self.sequence += 1
+        SHARED_SEQUENCE.pack_into(self.buf, self.offset, self.sequence)
+        SHARED_STAT.pack_into(self.buf, self.offset + SHARED_SEQUENCE.size,
+                              self.n, self.sum, self.sum2, self.min or 0, self.max or 0, self.skipped)
+        self.sequence += 1
+        SHARED_SEQUENCE.pack_into(self.buf, self.offset, self.sequence)
+
+
 class Timer(object):
 
-    def __init__(self, scopes, name):
+    def __init__(self, scopes, name, sample=None, labels=None):
         self.scopes = scopes
         self.name = name
-        self.start = None
+        self.sample = sample
+        self.labels = labels
 
     def __call__(self, f):
+        if inspect.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def pprofiler_async_wrapper(*a, **kv):
+                with self:
+                    return await f(*a, **kv)
+            return pprofiler_async_wrapper
+
         @functools.wraps(f)
         def pprofiler_wrapper(*a, **kv):
             with self:
@@ -77,13 +472,100 @@ class Timer(object):
         return pprofiler_wrapper
 
     def __enter__(self):
-        self.start = time.time()
-        self.scopes._enter(self.name)
+        self.scopes._enter(self.name, self.sample, self.labels)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.scopes._update(time.time() - self.start)
+        self.scopes._exit()
         return False
 
+    async def __aenter__(self):
+        self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return self.__exit__(exc_type, exc_val, exc_tb)
+
+
+class MemoryCounter(object):
+    """Traced memory and its peak for nested scopes.
+
+    tracemalloc keeps one peak for the whole process, so it is reset on
+    every enter, and the peak of outer scopes seen so far is kept here.
+    """
+
+    def __init__(self):
+        self.peaks = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def enter(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], peak)
+        self.peaks.append(current)
+        tracemalloc.reset_peak()
+        return current
+
+    def exit(self, start):
+        current, peak = tracemalloc.get_traced_memory()
+        return current - start, max(self.peaks.pop(), peak) - start
+
+
+class EventLog(object):
+    """Ring buffer of (scope, start, end, thread) events in preallocated arrays.
+
+    Scopes get small integer ids when they complete for the first time, no
+    objects are created per event. When the buffer is full, `overflow`
+    'overwrite' replaces the oldest events, 'drop' drops new ones; `lost`
+    counts both.
+    """
+
+    def __init__(self, size, overflow='overwrite'):
+        if overflow not in ('overwrite', 'drop'):
+            raise ValueError('pprofiler: unknown overflow {!r}'.format(overflow))
+        self.size = size
+        self.overflow = overflow
+        self.scope = array.array('i', [0]) * size
+        self.start = array.array('q', [0]) * size
+        self.end = array.array('q', [0]) * size
+        self.thread = array.array('Q', [0]) * size
+        self.count = 0  # events stored, including overwritten ones
+        self.lost = 0
+        self.ids = {}  # id(Scope): scope id
+        self.paths = []  # scope id: path of names
+        self.keep = []  # registered scopes, to keep their id()s unique
+
+    def register(self, scope, path):
+        self.ids[id(scope)] = len(self.paths)
+        self.paths.append(path)
+        self.keep.append(scope)
+
+    def record(self, scope, start, end):
+        """Store event; False if the scope is not registered yet."""
+        i = self.ids.get(id(scope))
+        if i is None:
+            return False
+        if self.count >= self.size:
+            self.lost += 1
+            if self.overflow == 'drop':
+                return True
+        j = self.count % self.size
+        self.scope[j] = i
+        self.start[j] = start
+        self.end[j] = end
+        self.thread[j] = threading.get_ident()
+        self.count += 1
+        return True
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def __iter__(self):
+        """(path, start, end, thread) of stored events in order of completion."""
+        first = self.count - len(self)
+        for j in range(first, self.count):
+            j %= self.size
+            yield self.paths[self.scope[j]], self.start[j], self.end[j], self.thread[j]
+
 
 class TableField(object):
 
@@ -106,24 +588,287 @@ class TableField(object):
     def format_value(self, value):
         return '{:{}{}{}s}'.format(value, self.fill, self.align, self.width)
 
+    def format_spec(self):  # to format whole rows at once
+        return '{%s:%s%s%ds}' % (self.name, self.fill, self.align, self.width)
+
 
 class Profiler(object):
 
-    def __init__(self):
+    calibration = None  # (inner, outer) cost of enter/exit in ticks, see calibrate()
+    compensate = False
+    unaccounted = False  # add rows of time not covered by nested scopes to reports
+    by_labels = False  # add rows of labels of scopes to reports
+
+    def __init__(self, percentiles=False, sample=None, windows=None, clocks=(), memory=False, events=None, overflow='overwrite',
+                 max_children=None, max_scopes=None, exemplars=None, slow=None, context=None, max_labels=None):
         self.stack = [Scope(stat=None, scopes={})]
+        self.starts = []  # start times are kept here, not in Timer, so one Timer can be shared
+        self.percentiles = percentiles
+        self.sample = check_sample(sample)  # N >= 1 to measure every N-th entry, 0 < p < 1 to measure with probability p
+        self.windows = windows  # (seconds, buckets) to keep stats of the last buckets*seconds by buckets
+        self.set_limits(max_children, max_scopes, max_labels)
+        self.interned = {}  # labels as given and sorted labels: sorted labels
+        self.events = None if events is None else EventLog(events, overflow)  # size of event log
+        self.set_clocks(clocks, memory)
+        self.set_exemplars(exemplars, slow, context)
+
+    def set_clocks(self, clocks, memory=False):
+        """Extra clocks to measure besides wall time: names of CLOCKS, e.g. ('cpu',), and traced memory."""
+        known = dict(CLOCKS)
+        for k in clocks:
+            if k not in known:
+                raise ValueError('pprofiler: unknown clock {!r}'.format(k))
+        self.clock_functions = tuple(getattr(time, known[k]) for k in clocks)
+        if memory and not hasattr(tracemalloc, 'reset_peak'):
+            raise RuntimeError('pprofiler: memory needs tracemalloc.reset_peak() of Python 3.9+')
+        self.memory = MemoryCounter() if memory else None
+        self.clocks = tuple(clocks) + (MEMORY if memory else ())
+        self.extended = bool(self.clocks) or self.events is not None  # False for the fast path
+
+    def __call__(self, name, sample=None, **labels):
+        return Timer(self, name, sample if sample is None else check_sample(sample), self.intern_labels(labels) if labels else None)
 
-    def __call__(self, name):
-        return Timer(self, name)
+    def intern_labels(self, labels):
+        """Sorted tuple of (name, str value) pairs; equal tuples are the same object.
 
-    def _enter(self, name):
-        self.stack.append(self.stack[-1].scopes.setdefault(name, Scope(stat=Stat(), scopes={})))
+        Results are cached by the labels as they are given, so repeated string
+        labels are not sorted again. Other values are converted on every call
+        (1 == 1.0 == True, they can not be told apart by the cache), reuse the
+        Timer for them. No more than MAX_INTERNED labels are kept. Names must
+        be valid OpenMetrics label names and not RESERVED_LABELS.
+        """
+        given = tuple(labels.items())
+        try:
+            return self.interned[given]
+        except (KeyError, TypeError):  # new or unhashable values
+            pass
+        for k in labels:
+            if k in RESERVED_LABELS or k.startswith('__') or not (k.isascii() and k.isidentifier()):
+                raise ValueError('pprofiler: bad label name {!r}'.format(k))
+        key = labels_key(labels)
+        if len(self.interned) < MAX_INTERNED:
+            key = self.interned.setdefault(key, key)
+            if all(type(v) is str for v in labels.values()):
+                self.interned[given] = key
+        return key
 
-    def _update(self, val):
-        self.stack.pop().stat.update(val)
+    def new_stat(self, name=None, exemplars=True):
+        """Stat of a scope; stats of labels get `exemplars=False`, slow calls are captured by their scope."""
+        captured = None
+        if exemplars and self.exemplars is not None:
+            slow = self.slow.get(name, self.slow.get(None)) if isinstance(self.slow, dict) else self.slow
+            captured = Exemplars(self.exemplars, int((slow or 0) * TICKS_PER_SECOND), self.context)
+        if self.windows is not None:
+            return WindowStat(*self.windows, histogram=self.percentiles, clocks=self.clocks, exemplars=captured)
+        return Stat(histogram=self.percentiles, clocks=self.clocks, exemplars=captured)
+
+    def new_scope(self, name=None):
+        return Scope(stat=self.new_stat(name), scopes={})
+
+    def set_exemplars(self, exemplars=None, slow=None, context=None):
+        """Keep `exemplars` slowest entries of every scope, longer than `slow` seconds.
+
+        `slow` is a number or a dict of numbers by scope name, None is the key
+        of the default. `context` is a function that returns what to keep
+        with an entry, a truncated stack is kept by default.
+        """
+        self.exemplars = exemplars
+        self.slow = slow
+        self.context = context
+
+    def set_limits(self, max_children=None, max_scopes=None, max_labels=None):
+        """Bound the tree: new names over the limits go to the OTHER_SCOPE of the parent.
+
+        New labels of a scope over `max_labels` (`max_children` if it is not
+        set) or over `max_scopes` go to OTHER_LABELS.
+        """
+        self.max_children = max_children
+        self.max_scopes = max_scopes
+        self.max_labels = max_children if max_labels is None else max_labels
+        self.scopes_number = 0  # scopes and labels created by entering them
+        self.dropped = 0  # entries of new names and labels that went to OTHER_SCOPE and OTHER_LABELS
+
+    def add_scope(self, scopes, name):
+        if ((self.max_children is not None and len(scopes) >= self.max_children) or
+                (self.max_scopes is not None and self.scopes_number >= self.max_scopes)):
+            self.dropped += 1
+            scope = scopes.get(OTHER_SCOPE)
+            if scope is None:  # the only scope over the limits
+                scope = scopes[OTHER_SCOPE] = self.new_scope(OTHER_SCOPE)
+            return scope
+        self.scopes_number += 1
+        scope = scopes[name] = self.new_scope(name)
+        return scope
+
+    def add_labels(self, scope, labels, name):
+        """Scope of labels of `scope`, like add_scope() it keeps the limits."""
+        r = scope.labels.get(labels) if scope.labels is not None else None
+        if r is not None:
+            return r
+        if ((self.max_labels is not None and scope.labels is not None and len(scope.labels) >= self.max_labels) or
+                (self.max_scopes is not None and self.scopes_number >= self.max_scopes)):
+            self.dropped += 1
+            return label_scope(scope, OTHER_LABELS, self.new_stat, name, False)
+        self.scopes_number += 1
+        return label_scope(scope, labels, self.new_stat, name, False)
+
+    def _enter(self, name, sample=None, labels=None):
+        scopes = self.stack[-1].scopes
+        scope = scopes.get(name)
+        if scope is None:
+            scope = self.add_scope(scopes, name)
+        if labels is not None:
+            scope = self.add_labels(scope, labels, name)
+        self.stack.append(scope)
+        if sample is None:
+            sample = self.sample
+        if sample is None or scope.stat.is_sampled(sample):
+            if not self.extended:
+                self.starts.append(time.perf_counter_ns())
+            else:
+                self.starts.append(start_extended(self))
+        else:
+            self.starts.append(None)
+
+    def _exit(self):
+        start = self.starts.pop()
+        if start is None:  # not sampled, no clock
+            self.stack.pop().stat.skip()
+        elif not self.extended:
+            self.stack.pop().stat.update(time.perf_counter_ns() - start)
+        else:
+            update_extended(self, self.stack[-1], time.perf_counter_ns(), start)
+            self.stack.pop()
+
+    @property
+    def root(self):
+        return self.stack[0]
+
+    @property
+    def roots(self):
+        """Trees that make `root` when merged by scope paths."""
+        return [self.root]
 
     @property
     def report(self):
-        return scopes_to_report(self.stack[0].scopes)
+        return scopes_to_report(self.report_tree().scopes, TICKS_PER_SECOND, unaccounted=self.unaccounted, by_labels=self.by_labels)
+
+    def report_tree(self):
+        root = self.root
+        if self.compensate and self.calibration is not None:
+            root, _ = compensate_scope(root, *self.calibration)
+        return root
+
+    def iter_report(self, top=None):
+        """Flat report rows, yielded lazily; `top` limits the number of children of every scope."""
+        for level, row in walk_report(self.report_tree().scopes, TICKS_PER_SECOND, top, self.unaccounted, self.by_labels):
+            row['level'] = level
+            yield row
+
+    @property
+    def name_report(self):
+        """Stats merged by scope name over all paths, with callers and callees; hottest first."""
+        return names_to_report(self.report_tree().scopes, TICKS_PER_SECOND)
+
+    @property
+    def name_lines(self):
+        """Table of name_report: every name is followed by its callers (<-) and callees (->)."""
+        report_fields = [
+            TableField('name', align_left=True, fill=True, extra_padding=2),
+            TableField('sum'),
+            TableField('self'),
+            TableField('n'),
+            TableField('avg'),
+            TableField('max'),
+            TableField('min'),
+        ]
+        lines = []
+        for s in self.name_report:
+            d = {k: '-' if s[k] is None else '{:.2f}'.format(s[k]) for k in ('sum', 'self', 'avg', 'min', 'max')}
+            d['name'] = s['name'] + ' '
+            d['n'] = '{:d}'.format(s['num'])
+            lines.append(d)
+            for mark, k in (('<-', 'callers'), ('->', 'callees')):
+                for c in s[k]:
+                    d = {k: '-' if c[k] is None else '{:.2f}'.format(c[k]) for k in ('sum', 'avg', 'min', 'max')}
+                    d['name'] = '  {} {} '.format(mark, c['name'])
+                    d['self'] = ''
+                    d['n'] = '{:d}'.format(c['num'])
+                    lines.append(d)
+        if lines:
+            for f in report_fields:
+                f.update_width(max(len(l[f.name]) for l in lines))
+        yield ' '.join(f.format_header() for f in report_fields)
+        yield ' '.join(f.format_separator() for f in report_fields)
+        row = ' '.join(f.format_spec() for f in report_fields)
+        for l in lines:
+            yield row.format(**l)
+
+    def slow_calls(self):
+        """Captured exemplars of all scopes, the slowest first; it needs `exemplars` option."""
+        r = []
+        path = []
+        stack = [iter(list(self.root.scopes.items()))]
+        while stack:
+            for name, scope in stack[-1]:
+                del path[len(stack) - 1:]
+                path.append(name)
+                if scope.stat.exemplars is not None:
+                    for d, _, t, thread, context in scope.stat.exemplars.heap:
+                        r.append({
+                            'path': '/'.join(path),
+                            'duration': d / TICKS_PER_SECOND,
+                            'time': t,
+                            'thread': thread,
+                            'context': context,
+                        })
+                if scope.scopes:
+                    stack.append(iter(list(scope.scopes.items())))
+                break
+            else:
+                stack.pop()
+        r.sort(key=lambda x: x['duration'], reverse=True)
+        return r
+
+    def folded(self, weight='self'):
+        """Folded stack lines `a;b;c value` for flame graphs, streamed from the tree.
+
+        `weight` is 'self' (time in ns without nested scopes, the usual input
+        of flamegraph.pl), 'total' (time in ns with nested scopes) or 'count'.
+        """
+        if weight not in ('self', 'total', 'count'):
+            raise ValueError('pprofiler: unknown weight {!r}'.format(weight))
+        return fold_scopes(self.report_tree().scopes, weight)
+
+    def calibrate(self, n=10000, repeat=5, compensate=True):
+        """Measure own cost of enter/exit, the best of `repeat` rounds of `n` empty scopes.
+
+        `inner` is the part of the cost that falls inside the measured time of
+        a scope, `outer` is the whole cost, it falls into the time of the
+        parent scope. With `compensate` reports subtract `inner` for every
+        measured entry and `outer` for every entry of nested scopes.
+        """
+        timer = self(CALIBRATION_SCOPE, sample=1)
+        scopes = self.stack[-1].scopes
+        inner = outer = None
+        for _ in range(repeat):
+            scopes[CALIBRATION_SCOPE] = self.new_scope(CALIBRATION_SCOPE)  # not by add_scope(): no limits, not counted
+            t0 = time.perf_counter_ns()
+            for _ in range(n):
+                pass
+            t1 = time.perf_counter_ns()
+            for _ in range(n):
+                with timer:
+                    pass
+            t2 = time.perf_counter_ns()
+            stat = scopes.pop(CALIBRATION_SCOPE).stat
+            if inner is None or stat.sum / n < inner:
+                inner = stat.sum / n
+            if outer is None or (t2 - t1 - (t1 - t0)) / n < outer:
+                outer = (t2 - t1 - (t1 - t0)) / n
+        self.calibration = (inner, max(inner, outer))
+        self.compensate = compensate
+        return self.calibration
 
     @property
     def is_complete(self):
@@ -134,7 +879,238 @@ class Profiler(object):
             raise RuntimeError('pprofiler: report can not be prepared, not all measurements completed')
 
     def __iter__(self):
-        return report_to_flat(self.report)
+        return self.iter_report()
+
+    def merge(self, *others):
+        """Merge other profilers into this one by scope paths.
+
+        Every node of every profiler is visited once, so reducing a pool of
+        workers with `Profiler().merge(*workers)` takes O(total nodes).
+        """
+        for other in others:
+            merge_scopes(self.stack[0].scopes, other.root.scopes)
+        return self
+
+    def dumps(self):
+        """Compact binary form of the scope tree.
+
+        Header, string table of scope names, clock names and labels (lengths,
+        then UTF-8 bytes), fixed-width node records, extra clock records,
+        label records and non-empty histogram buckets of all nodes. Parent
+        records always go before children. Stats of labels are kept without
+        histograms and clocks.
+        """
+        names = {}
+        blobs = []
+        nodes = []
+        clocks = []
+        labels = []
+        buckets = []
+
+        def name_index(name):
+            i = names.get(name)
+            if i is None:
+                i = names[name] = len(blobs)
+                blobs.append(name.encode('utf-8'))
+            return i
+
+        stack = [(-1, self.root.scopes)]
+        while stack:
+            parent, scopes = stack.pop()
+            for name, scope in list(scopes.items()):
+                i = name_index(name)
+                s = scope.stat
+                h = []
+                if s.histogram is not None:
+                    h = [DUMP_BUCKET.pack(b, c) for b, c in enumerate(s.histogram.counts) if c]
+                    buckets.extend(h)
+                c = []
+                if s.clocks is not None:
+                    c = [DUMP_CLOCK.pack(name_index(k), v.n, v.sum, v.sum2, v.min, v.max) for k, v in s.clocks.items() if v.n > 0]
+                    clocks.extend(c)
+                ls = []
+                if scope.labels:
+                    for lk, lv in scope.labels.items():
+                        v = lv.stat.stat
+                        ls.append(DUMP_LABEL.pack(name_index(json.dumps(lk)), v.n, v.sum, v.sum2, v.min or 0, v.max or 0, v.skipped))
+                    labels.extend(ls)
+                if s.n > 0:
+                    nodes.append(DUMP_NODE.pack(parent, i, s.n, s.sum, s.sum2, s.min, s.max, s.skipped, len(h), len(c), len(ls)))
+                else:
+                    nodes.append(DUMP_NODE.pack(parent, i, 0, 0, 0., 0, 0, s.skipped, 0, 0, len(ls)))
+                if scope.scopes:
+                    stack.append((len(nodes) - 1, scope.scopes))
+        return b''.join(
+            [DUMP_HEADER.pack(DUMP_MAGIC, DUMP_VERSION, len(blobs), len(nodes), len(clocks), len(labels))] +
+            [DUMP_NAME_LENGTH.pack(len(b)) for b in blobs] +
+            blobs +
+            nodes +
+            clocks +
+            labels +
+            buckets)
+
+    def split(self, size):
+        """Profilers with parts of the tree, dumps() of every part is no more than `size` bytes.
+
+        Every part keeps stats of its own scopes and empty stats of their
+        parents, so merging all parts gives the whole tree. Scopes without
+        entries are left out. A scope that does not fit alone makes a part
+        of its own, its dump is larger.
+        """
+        parts = []
+        part = None
+        used = 0
+        path = []
+        placed = []  # scopes of the part for the beginning of the path
+        stack = [iter(list(self.root.scopes.items()))]
+        while stack:
+            for name, scope in stack[-1]:
+                depth = len(stack) - 1
+                del path[depth:]
+                del placed[depth:]
+                path.append(name)
+                if scope.stat.n > 0 or scope.stat.skipped > 0 or scope.labels:
+                    cost = dump_size(name, scope) + sum(dump_size(k, None) for k in path[len(placed):depth])
+                    if part is None or used + cost > size:
+                        part = Profiler()
+                        parts.append(part)
+                        used = DUMP_HEADER.size
+                        del placed[:]
+                        cost = dump_size(name, scope) + sum(dump_size(k, None) for k in path[:depth])
+                    scopes = placed[-1].scopes if placed else part.root.scopes
+                    for k in path[len(placed):depth]:  # parents without entries or from other parts
+                        parent = scopes[k] = Scope(stat=Stat(), scopes={})
+                        placed.append(parent)
+                        scopes = parent.scopes
+                    placed.append(Scope(stat=scope.stat, scopes={}, labels=scope.labels))
+                    scopes[name] = placed[-1]
+                    used += cost
+                if scope.scopes:
+                    stack.append(iter(list(scope.scopes.items())))
+                break
+            else:
+                stack.pop()
+        return parts
+
+    def merge_bytes(self, data):
+        """Merge a dumps() result (bytes, bytearray or memoryview) into this profiler.
+
+        Records are merged right into the tree, no intermediate Stat or Scope
+        objects are built.
+        """
+        view = memoryview(data)
+        if len(view) < DUMP_HEADER.size:
+            raise ValueError('pprofiler: truncated dump')
+        magic, version, names_num, nodes_num, clocks_num, labels_num = DUMP_HEADER.unpack_from(view)
+        if magic != DUMP_MAGIC:
+            raise ValueError('pprofiler: not a dump')
+        if version != DUMP_VERSION:
+            raise ValueError('pprofiler: unsupported dump version {}'.format(version))
+        offset = DUMP_HEADER.size + DUMP_NAME_LENGTH.size * names_num
+        if len(view) < offset:
+            raise ValueError('pprofiler: truncated dump')
+        names = []
+        for (length,) in DUMP_NAME_LENGTH.iter_unpack(view[DUMP_HEADER.size:offset]):
+            names.append(str(view[offset:offset + length], 'utf-8'))
+            offset += length
+        clocks_offset = offset + DUMP_NODE.size * nodes_num
+        labels_offset = clocks_offset + DUMP_CLOCK.size * clocks_num
+        buckets_offset = labels_offset + DUMP_LABEL.size * labels_num
+        if len(view) < buckets_offset or (len(view) - buckets_offset) % DUMP_BUCKET.size:
+            raise ValueError('pprofiler: truncated dump')
+        clocks = DUMP_CLOCK.iter_unpack(view[clocks_offset:labels_offset])
+        labels = DUMP_LABEL.iter_unpack(view[labels_offset:buckets_offset])
+        buckets = DUMP_BUCKET.iter_unpack(view[buckets_offset:])
+        root = self.stack[0].scopes
+        nodes = []
+        for parent, name, n, s, s2, lo, hi, skipped, h, c, ls in DUMP_NODE.iter_unpack(view[offset:clocks_offset]):
+            scopes = root if parent < 0 else nodes[parent]
+            scope = scopes.get(names[name])
+            if scope is None:
+                scope = scopes[names[name]] = Scope(stat=Stat(), scopes={})
+            stat = scope.stat.merge_values(n, s, s2, lo, hi, skipped)
+            for k, cn, cs, cs2, clo, chi in itertools.islice(clocks, c):
+                stat.clock(names[k]).merge_values(cn, cs, cs2, clo, chi)
+            for k, ln, lsum, lsum2, llo, lhi, lskipped in itertools.islice(labels, ls):
+                try:
+                    lk = labels_key(dict(json.loads(names[k])))
+                except (TypeError, ValueError):
+                    raise ValueError('pprofiler: bad labels in dump')
+                label_scope(scope, lk, Stat).stat.stat.merge_values(ln, lsum, lsum2, llo, lhi, lskipped)
+            if h:
+                if stat.histogram is None:
+                    stat.histogram = Histogram()
+                counts = stat.histogram.counts
+                for b, c in itertools.islice(buckets, h):
+                    counts[b] += c
+            nodes.append(scope.scopes)
+        return self
+
+    @classmethod
+    def loads(cls, data):
+        return cls().merge_bytes(data)
+
+    def trace_events(self):
+        """(path, start, end, thread) of recorded events; it needs `events` option."""
+        if self.events is None:
+            raise RuntimeError('pprofiler: events are not enabled')
+        return iter(self.events)
+
+    def chrome_trace(self):
+        """Recorded events as a Chrome Trace Event JSON object (chrome://tracing, Perfetto)."""
+        return chrome_trace(self.trace_events(), os.getpid())
+
+    def speedscope(self):
+        """Recorded events as a speedscope JSON object."""
+        return speedscope(self.trace_events())
+
+    def window(self, seconds):
+        """Profiler with stats of the last `seconds`; it needs `windows` option."""
+        if self.windows is None:
+            raise RuntimeError('pprofiler: windows are not enabled')
+        r = Profiler()
+        window_scopes(r.stack[0].scopes, self.root.scopes, seconds, time.perf_counter_ns())
+        return r
+
+    def snapshot(self):
+        """Copy of all stats collected so far."""
+        return Profiler().merge(self)
+
+    def swap(self):
+        """Return stats collected since the previous swap and start collecting anew.
+
+        Stats are replaced scope by scope, while the tree and the stack stay as
+        they are, so it is safe while scopes are open. Open entries are
+        counted in the new interval, when they complete.
+        """
+        r = Profiler()
+        swap_scopes(r.stack[0].scopes, self.stack[0].scopes, self.new_stat)
+        return r
+
+    def __add__(self, other):
+        if not isinstance(other, Profiler):
+            return NotImplemented
+        return Profiler().merge(self, other)
+
+    def __sub__(self, other):
+        """Delta between two snapshots: `later - earlier`."""
+        if not isinstance(other, Profiler):
+            return NotImplemented
+        r = Profiler().merge(self)
+        subtract_scopes(r.stack[0].scopes, other.root.scopes)
+        return r
+
+    def __radd__(self, other):
+        """To support sum(); every step of sum() copies the tree, merge(*others) is linear."""
+        if other == 0:
+            return Profiler().merge(self)
+        return NotImplemented
+
+    def __iadd__(self, other):
+        """Merge `other` in place, as merge() does."""
+        if not isinstance(other, Profiler):
+            return NotImplemented
+        return self.merge(other)
 
     @property
     def lines(self):
@@ -149,20 +1125,60 @@ class Profiler(object):
             TableField('dev'),
         ]
         lines = []
+        nested = False
         for s in self:
-            d = {k: '-' if s[k] is None else '{:.2f}'.format(s[k]) for k in ('sum', 'avg', 'min', 'max', 'dev')}
+            d = {k: '-' if s[k] is None else '{:.2f}'.format(s[k]) for k in ('sum', 'self', 'avg', 'min', 'max', 'dev')}
             d['name'] = '. ' * s['level'] + s['name'] + ' '
             d['perc'] = '{:.0f}%'.format(s['percent'])
+            d['root%'] = '{:.0f}%'.format(s['root_percent'])
+            nested = nested or s['level'] > 0
             d['n'] = '{:d}'.format(s['num'])
+            if s.get('estimated'):
+                d['sum'] = '~' + d['sum']
+                d['n'] = '~' + d['n']
+            for k, _ in PERCENTILES:
+                if k in s:
+                    d[k] = '-' if s[k] is None else '{:.2f}'.format(s[k])
+            for k, _ in CLOCKS:
+                if k in s:
+                    d[k] = '{:.2f}'.format(s[k])
+                    d[k + '%'] = '-' if s[k + '%'] is None else '{:.0f}%'.format(s[k + '%'])
+            for k in MEMORY:
+                if k in s:
+                    d[k] = '-' if s[k] is None else '{:.0f}'.format(s[k])
             lines.append(d)
-        fields = {f.name: f for f in report_fields}
-        for l in lines:
-            for n, f in l.items():
-                fields[n].update_width(len(f))
+        if nested:  # self time and share of the whole differ from sum and perc
+            report_fields.insert(2, TableField('root%'))
+            report_fields.insert(4, TableField('self'))
+        for k, _ in CLOCKS:
+            if any(k in l for l in lines):
+                report_fields.extend((TableField(k), TableField(k + '%')))
+                for l in lines:
+                    l.setdefault(k, '-')
+                    l.setdefault(k + '%', '-')
+        if any('alloc' in l for l in lines):
+            report_fields.extend(TableField(k) for k in MEMORY)
+            for l in lines:
+                for k in MEMORY:
+                    l.setdefault(k, '-')
+        if any(k in l for l in lines for k, _ in PERCENTILES):
+            report_fields.extend(TableField(k) for k, _ in PERCENTILES)
+            for l in lines:
+                for k, _ in PERCENTILES:
+                    l.setdefault(k, '-')
+        if lines:
+            for f in report_fields:
+                f.update_width(max(len(l[f.name]) for l in lines))
         yield ' '.join(f.format_header() for f in report_fields)
         yield ' '.join(f.format_separator() for f in report_fields)
+        row = ' '.join(f.format_spec() for f in report_fields)
         for l in lines:
-            yield ' '.join(f.format_value(l[f.name]) for f in report_fields)
+            yield row.format(**l)
+        if self.calibration is not None:
+            yield 'calibration: {:.0f}ns per scope, {:.0f}ns inside it ({})'.format(
+                self.calibration[1], self.calibration[0], 'compensated' if self.compensate else 'not compensated')
+        if self.dropped:
+            yield 'dropped: {:d} entries of new scopes went to {} over the limits'.format(self.dropped, OTHER_SCOPE)
 
     def print_report(self, printer=None):
         if printer is None:
@@ -171,41 +1187,1224 @@ class Profiler(object):
             printer(s)
 
 
+class ThreadProfiler(Profiler):
+    """Profiler for multithreaded code.
+
+    Each thread gets its own stack and scope tree (a plain Profiler), so
+    enter/exit takes no locks. The lock is taken only once per thread, when
+    the thread registers itself. Reports merge all thread trees on demand.
+    """
+
+    def __init__(self, **options):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.threads = []  # [(thread name, Profiler)]
+        check_sample(options.get('sample'))  # thread profilers are made later, check it now
+        self.options = options  # for thread profilers
+        self.interned = {}  # labels of timers, they are made in any thread
+
+    def _thread_profiler(self):
+        try:
+            return self.local.profiler
+        except AttributeError:
+            p = self.local.profiler = Profiler(**self.options)
+            with self.lock:
+                self.threads.append((threading.current_thread().name, p))
+            return p
+
+    def _enter(self, name, sample=None, labels=None):
+        self._thread_profiler()._enter(name, sample, labels)
+
+    def _exit(self):
+        self._thread_profiler()._exit()
+
+    def new_scope(self, name=None):
+        return self._thread_profiler().new_scope(name)
+
+    @property
+    def stack(self):
+        return self._thread_profiler().stack
+
+    @property
+    def root(self):
+        root = Scope(stat=None, scopes={})
+        for _, p in list(self.threads):
+            merge_scopes(root.scopes, p.root.scopes)
+        return root
+
+    @property
+    def roots(self):
+        return [p.root for _, p in list(self.threads)]
+
+    @property
+    def is_complete(self):
+        return all(p.is_complete for _, p in list(self.threads))
+
+    @property
+    def dropped(self):
+        return sum(p.dropped for _, p in list(self.threads))
+
+    def swap(self):
+        """Swap stats of all threads.
+
+        A thread that is leaving a scope at the very moment can put its last
+        measurement into the returned stats after they are returned; so it is
+        exact only for the calling thread.
+        """
+        r = Profiler()
+        for _, p in list(self.threads):
+            r.merge(p.swap())
+        return r
+
+    def window(self, seconds):
+        r = Profiler()
+        for _, p in list(self.threads):
+            r.merge(p.window(seconds))
+        return r
+
+    def trace_events(self):
+        return itertools.chain.from_iterable([p.trace_events() for _, p in list(self.threads)])
+
+    @property
+    def per_thread(self):
+        r = {}
+        for name, p in list(self.threads):
+            if name not in r:
+                r[name] = Profiler()
+            merge_scopes(r[name].root.scopes, p.root.scopes)
+        return r
+
+
+class AsyncProfiler(Profiler):
+    """Profiler for asyncio code.
+
+    The current scope is kept in a ContextVar, so every task has its own
+    stack, while all tasks share one scope tree. A frame is an immutable
+    (scope, start, parent frame) tuple, because tasks get shallow copies
+    of the context.
+    """
+
+    def __init__(self, percentiles=False, sample=None, windows=None, clocks=(), max_children=None, max_scopes=None,
+                 exemplars=None, slow=None, context=None, max_labels=None):
+        self.tree = Scope(stat=None, scopes={})
+        self.frame = contextvars.ContextVar('pprofiler_frame', default=None)
+        self.open = 0
+        self.percentiles = percentiles
+        self.sample = check_sample(sample)
+        self.windows = windows
+        self.events = None  # tasks of one thread overlap, they do not make a timeline of nested events
+        self.set_clocks(clocks)  # no memory: tasks do not nest, and traced memory is one for all of them
+        self.set_limits(max_children, max_scopes, max_labels)
+        self.interned = {}
+        self.set_exemplars(exemplars, slow, context)
+
+    def _enter(self, name, sample=None, labels=None):
+        frame = self.frame.get()
+        scopes = self.tree.scopes if frame is None else frame[0].scopes
+        scope = scopes.get(name)
+        if scope is None:
+            scope = self.add_scope(scopes, name)
+        if labels is not None:
+            scope = self.add_labels(scope, labels, name)
+        self.open += 1
+        if sample is None:
+            sample = self.sample
+        if sample is None or scope.stat.is_sampled(sample):
+            if not self.extended:
+                self.frame.set((scope, time.perf_counter_ns(), frame))
+            else:
+                self.frame.set((scope, start_extended(self), frame))
+        else:
+            self.frame.set((scope, None, frame))
+
+    def _exit(self):
+        scope, start, frame = self.frame.get()
+        if start is None:  # not sampled, no clock
+            scope.stat.skip()
+        elif not self.extended:
+            scope.stat.update(time.perf_counter_ns() - start)
+        else:
+            update_extended(self, scope, time.perf_counter_ns(), start)
+        self.frame.set(frame)
+        self.open -= 1
+
+    @property
+    def stack(self):
+        r = []
+        frame = self.frame.get()
+        while frame is not None:
+            r.append(frame[0])
+            frame = frame[2]
+        r.append(self.tree)
+        return r[::-1]
+
+    @property
+    def root(self):
+        return self.tree
+
+    @property
+    def is_complete(self):
+        return self.open == 0
+
+
+class SharedStats(object):
+    """Stats of worker processes in shared memory; readers merge them at any moment.
+
+    The region is a header, a table of `slots` scope names (parent slot and
+    name) and a stat slot for every worker and scope. A worker writes its own
+    slots only, without locks or IPC; the lock is taken to claim a worker and
+    to register a new scope. Pass it to workers on their creation (Process or
+    Pool initializer arguments), like any multiprocessing lock; `mp_context`
+    is the multiprocessing context of the workers, if it is not the default.
+    """
+
+    def __init__(self, workers, slots=1024, mp_context=None):
+        self.lock = (mp_context or multiprocessing).Lock()
+        self.memory = multiprocessing.shared_memory.SharedMemory(
+            create=True,
+            size=SHARED_HEADER.size + SHARED_COUNTERS.size + slots * (SHARED_NAME.size + workers * (SHARED_SEQUENCE.size + SHARED_STAT.size)))
+        SHARED_HEADER.pack_into(self.memory.buf, 0, SHARED_MAGIC, SHARED_VERSION, workers, slots)
+        SHARED_COUNTERS.pack_into(self.memory.buf, SHARED_HEADER.size, 0, 0)
+        self.owner = True  # the creator frees the memory on close
+        self.attach()
+
+    def __getstate__(self):
+        return self.memory.name, self.lock
+
+    def __setstate__(self, state):
+        name, self.lock = state
+        self.memory = multiprocessing.shared_memory.SharedMemory(name)
+        self.owner = False
+        self.attach()
+
+    def attach(self):
+        magic, version, self.workers, self.slots = SHARED_HEADER.unpack_from(self.memory.buf)
+        if magic != SHARED_MAGIC or version != SHARED_VERSION:
+            raise ValueError('pprofiler: not shared stats')
+        self.names_offset = SHARED_HEADER.size + SHARED_COUNTERS.size
+        self.stats_offset = self.names_offset + self.slots * SHARED_NAME.size
+        self.names = {}  # (parent slot, name): slot
+        self.nodes = []  # slot: (parent slot, name)
+
+    def counters(self):
+        """Numbers of registered scopes and of claimed workers."""
+        return SHARED_COUNTERS.unpack_from(self.memory.buf, SHARED_HEADER.size)
+
+    def load_names(self):
+        """Read names registered by other processes; a name record is written before the counter."""
+        registered, _ = self.counters()
+        for i in range(len(self.nodes), registered):
+            parent, length, name = SHARED_NAME.unpack_from(self.memory.buf, self.names_offset + i * SHARED_NAME.size)
+            name = str(name[:length], 'utf-8')
+            self.names[parent, name] = i
+            self.nodes.append((parent, name))
+
+    def register(self, parent, name):
+        """Slot of a scope, it is registered if it is new; None if the table is full."""
+        name = shared_name(name)
+        slot = self.names.get((parent, name))
+        if slot is not None or len(self.nodes) >= self.slots:
+            return slot
+        with self.lock:
+            self.load_names()
+            slot = self.names.get((parent, name))
+            if slot is None and len(self.nodes) < self.slots:
+                slot = len(self.nodes)
+                b = name.encode('utf-8')
+                SHARED_NAME.pack_into(self.memory.buf, self.names_offset + slot * SHARED_NAME.size, parent, len(b), b)
+                _, claimed = self.counters()
+                SHARED_COUNTERS.pack_into(self.memory.buf, SHARED_HEADER.size, slot + 1, claimed)
+                self.names[parent, name] = slot
+                self.nodes.append((parent, name))
+        return slot
+
+    def stat_offset(self, worker, slot):
+        return self.stats_offset + (worker * self.slots + slot) * (SHARED_SEQUENCE.size + SHARED_STAT.size)
+
+    def profiler(self, sample=None):
+        """Profiler of a worker process; every call claims a new worker."""
+        with self.lock:
+            registered, claimed = self.counters()
+            if claimed >= self.workers:
+                raise RuntimeError('pprofiler: all {:d} workers are claimed'.format(self.workers))
+            SHARED_COUNTERS.pack_into(self.memory.buf, SHARED_HEADER.size, registered, claimed + 1)
+        return SharedProfiler(self, claimed, sample)
+
+    def read(self, worker, slot):
+        """(n, sum, sum2, min, max, skipped) of a slot."""
+        offset = self.stat_offset(worker, slot)
+        buf = self.memory.buf
+        for _ in range(SHARED_RETRIES):
+            sequence, = SHARED_SEQUENCE.unpack_from(buf, offset)
+            values = SHARED_STAT.unpack_from(buf, offset + SHARED_SEQUENCE.size)
+            if sequence % 2 == 0 and SHARED_SEQUENCE.unpack_from(buf, offset)[0] == sequence:
+                break
+        return values  # the last read if the writer has died in the middle of a write
+
+    def snapshot(self, worker=None):
+        """Profiler with stats of all workers merged, or of one `worker`; workers may be running."""
+        self.load_names()
+        _, claimed = self.counters()
+        workers = range(claimed) if worker is None else (worker,)
+        r = Profiler()
+        nodes = []
+        for slot, (parent, name) in enumerate(self.nodes):
+            scopes = r.root.scopes if parent < 0 else nodes[parent].scopes
+            scope = scopes[name] = Scope(stat=Stat(), scopes={})
+            for w in workers:
+                scope.stat.merge_values(*self.read(w, slot))
+            nodes.append(scope)
+        return r
+
+    def close(self):
+        """Detach from the memory; the creator also frees it."""
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class SharedProfiler(Profiler):
+    """Profiler of a worker of SharedStats, see SharedStats.profiler().
+
+    Scopes get SharedStat, so every exit is written through to the slots of
+    the worker. When the table is full, new scopes go to the OTHER_SCOPE of
+    their parent, it is kept locally and it is not seen by readers; so is
+    the scope of calibrate().
+    """
+
+    def __init__(self, shared, worker, sample=None):
+        super(SharedProfiler, self).__init__(sample=sample)
+        self.shared = shared
+        self.worker = worker
+        self.parents = {id(self.stack[0].scopes): -1}  # id of nested scopes dict: slot of its scope
+
+    def add_scope(self, scopes, name):
+        name = shared_name(name)  # names truncated to one slot are one scope
+        scope = scopes.get(name)
+        if scope is not None:
+            return scope
+        parent = self.parents.get(id(scopes))
+        slot = None if parent is None else self.shared.register(parent, name)
+        if slot is None:  # the table is full
+            self.dropped += 1
+            scope = scopes.get(OTHER_SCOPE)
+            if scope is None:
+                scope = scopes[OTHER_SCOPE] = self.new_scope(OTHER_SCOPE)
+            return scope
+        scope = scopes[name] = Scope(stat=SharedStat(self.shared.memory.buf, self.shared.stat_offset(self.worker, slot)), scopes={})
+        self.parents[id(scope.scopes)] = slot
+        return scope
+
+    def swap(self):
+        raise RuntimeError('pprofiler: shared stats can not be swapped')
+
+
+class OpenMetricsExporter(object):
+    """Scopes as OpenMetrics text, the scope path is a label.
+
+    Text of every scope is cached and rebuilt only when the scope gets new
+    entries; a text younger than `max_age` seconds is returned as is, without
+    looking at the tree at all. `serve()` starts an HTTP server in a
+    background thread.
+    """
+
+    HISTOGRAM_EDGES = tuple(range(10, 41, 2))  # buckets le=2**e ns, ~1us to ~18min
+
+    def __init__(self, profiler, prefix='pprofiler', max_age=1.):
+        self.profiler = profiler
+        self.prefix = prefix
+        self.max_age = max_age
+        self.families = (
+            ('scope_calls', 'counter', 'Number of scope entries.'),
+            ('scope_seconds', 'counter', 'Total time in scope.'),
+            ('scope_min_seconds', 'gauge', 'The shortest time in scope.'),
+            ('scope_max_seconds', 'gauge', 'The longest time in scope.'),
+            ('scope_duration_seconds', 'histogram', 'Time in scope.'),
+        )
+        self.cache = {}  # scope path: (version of stat, text by family)
+        self.text = None
+        self.rendered = None
+        self.lock = threading.Lock()
+        self.server = None
+
+    def render(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.text is None or now - self.rendered >= self.max_age:
+                self.text = self.render_tree()
+                self.rendered = now
+            return self.text
+
+    def render_tree(self):
+        """Render changed scopes only; trees of threads are walked side by side, so stats are merged only to render."""
+        families = [[] for _ in self.families]
+        cache = {}
+        stack = [((), [root.scopes for root in self.profiler.roots])]
+        while stack:
+            path, trees = stack.pop()
+            same = {}  # name: scopes of the name in all trees
+            for scopes in trees:
+                for name, scope in list(scopes.items()):
+                    same.setdefault(name, []).append(scope)
+            for name, group in same.items():
+                p = path + (name,)
+                version = tuple((id(scope.stat), scope.stat.n, scope.stat.skipped, scope.stat.sum) for scope in group)  # swap() replaces stats
+                c = self.cache.get(p)
+                if c is None or c[0] != version:
+                    scope = group[0]
+                    if len(group) > 1:
+                        scope = Scope(stat=Stat(), scopes={})
+                        for v in group:
+                            merge_scope(scope, v)
+                    c = (version, self.render_labeled(p, scope))
+                cache[p] = c
+                for f, text in zip(families, c[1]):
+                    f.append(text)
+                children = [scope.scopes for scope in group if scope.scopes]
+                if children:
+                    stack.append((p, children))
+        self.cache = cache
+        r = []
+        for (name, kind, description), texts in zip(self.families, families):
+            r.append('# TYPE {}_{} {}\n# HELP {}_{} {}\n'.format(self.prefix, name, kind, self.prefix, name, description))
+            r.extend(texts)
+        r.append('# EOF\n')
+        return ''.join(r)
+
+    def render_labeled(self, path, scope):
+        """Series of every labels of the scope, and of the rest of entries of the scope."""
+        if not scope.labels:
+            return self.render_scope(path, scope.stat)
+        parts = []
+        labeled = Stat()
+        for labels, v in list(scope.labels.items()):
+            parts.append(self.render_scope(path, v.stat.stat, labels))
+            labeled.merge(v.stat.stat)
+        rest = scope.stat - labeled
+        if rest.n > 0 or rest.skipped > 0:
+            parts.append(self.render_scope(path, rest))
+        return [''.join(texts) for texts in zip(*parts)]
+
+    def render_scope(self, path, stat, labels=()):
+        label = ','.join('{}="{}"'.format(k, escape_label(v)) for k, v in (('scope', '/'.join(path)),) + labels)
+        s = stat.stat
+        p = self.prefix
+        r = [
+            '{}_scope_calls_total{{{}}} {}\n'.format(p, label, s['num']),
+            '{}_scope_seconds_total{{{}}} {!r}\n'.format(p, label, s['sum'] / TICKS_PER_SECOND),
+            '',
+            '',
+            '',
+        ]
+        if stat.n > 0:
+            r[2] = '{}_scope_min_seconds{{{}}} {!r}\n'.format(p, label, stat.min / TICKS_PER_SECOND)
+            r[3] = '{}_scope_max_seconds{{{}}} {!r}\n'.format(p, label, stat.max / TICKS_PER_SECOND)
+        if stat.histogram is not None:
+            h = []
+            for e, c in zip(self.HISTOGRAM_EDGES, stat.histogram.cumulative(self.HISTOGRAM_EDGES)):
+                h.append('{}_scope_duration_seconds_bucket{{{},le="{!r}"}} {}\n'.format(p, label, 2 ** e / TICKS_PER_SECOND, c))
+            h.append('{}_scope_duration_seconds_bucket{{{},le="+Inf"}} {}\n'.format(p, label, stat.n))
+            h.append('{}_scope_duration_seconds_count{{{}}} {}\n'.format(p, label, stat.n))
+            h.append('{}_scope_duration_seconds_sum{{{}}} {!r}\n'.format(p, label, stat.sum / TICKS_PER_SECOND))
+            r[4] = ''.join(h)
+        return r
+
+    def serve(self, port=0, host='127.0.0.1'):
+        """Serve /metrics in a background thread; returns (host, port)."""
+        import http.server  # not at the top: it imports ssl and email, import of pprofiler stays light
+        self.server = http.server.ThreadingHTTPServer((host, port), openmetrics_handler(http.server.BaseHTTPRequestHandler))
+        self.server.exporter = self
+        threading.Thread(target=self.server.serve_forever, name='pprofiler-exporter', daemon=True).start()
+        return self.server.server_address
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+@functools.lru_cache(maxsize=None)
+def openmetrics_handler(base):
+    """Request handler of /metrics, made on the first serve() with http.server imported."""
+
+    class OpenMetricsHandler(base):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = self.server.exporter.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return OpenMetricsHandler
+
+
+class Sink(object):
+    """Batched storage of flat report rows.
+
+    Every row gets run id, timestamp and scope path. Rows are written by
+    `write_rows()` of subclasses, when `batch` rows are collected or
+    `interval` seconds passed since the last flush.
+    """
+
+    FIELDS = ('run', 'time', 'path', 'level', 'name', 'num', 'sum', 'avg', 'dev', 'min', 'max', 'percent')
+
+    def __init__(self, run=None, batch=1000, interval=60.):
+        self.run = uuid.uuid4().hex if run is None else run
+        self.batch = batch
+        self.interval = interval
+        self.rows = []
+        self.flushed = time.monotonic()
+
+    def add(self, profiler, timestamp=None):
+        t = time.time() if timestamp is None else timestamp
+        path = []
+        for r in profiler:
+            del path[r['level']:]
+            path.append(r['name'])
+            r['run'] = self.run
+            r['time'] = t
+            r['path'] = '/'.join(path)
+            self.rows.append(r)
+            if len(self.rows) >= self.batch:
+                self.flush()
+        if time.monotonic() - self.flushed >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.write_rows(self.rows)
+            self.rows = []
+        self.flushed = time.monotonic()
+
+    def write_rows(self, rows):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class SQLiteSink(Sink):
+
+    TYPES = {'run': 'TEXT', 'path': 'TEXT', 'name': 'TEXT', 'level': 'INTEGER', 'num': 'INTEGER'}
+
+    def __init__(self, database, table='pprofiler', **kv):
+        super(SQLiteSink, self).__init__(**kv)
+        self.connection = sqlite3.connect(database) if isinstance(database, str) else database
+        self.table = table
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+            table, ', '.join('{} {}'.format(f, self.TYPES.get(f, 'REAL')) for f in self.FIELDS)))
+        self.insert = 'INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(self.FIELDS), ', '.join('?' * len(self.FIELDS)))
+
+    def write_rows(self, rows):
+        with self.connection:
+            self.connection.executemany(self.insert, [tuple(r[f] for f in self.FIELDS) for r in rows])
+
+
+class CSVSink(Sink):
+
+    def __init__(self, stream, header=True, **kv):
+        super(CSVSink, self).__init__(**kv)
+        self.stream = stream
+        self.writer = csv.DictWriter(stream, self.FIELDS, extrasaction='ignore')
+        if header:
+            self.writer.writeheader()
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+        self.stream.flush()
+
+
+class JSONLinesSink(Sink):
+
+    def __init__(self, stream, **kv):
+        super(JSONLinesSink, self).__init__(**kv)
+        self.stream = stream
+
+    def write_rows(self, rows):
+        self.stream.write(''.join(json.dumps(r, sort_keys=True) + '\n' for r in rows))
+        self.stream.flush()
+
+
+class DeltaSender(object):
+    """Sender of deltas of a profiler (swap()) to a Collector.
+
+    A delta is split into datagrams of no more than `size` bytes, every one
+    is a dump of a part of the tree. `push()` sends only when `interval`
+    seconds passed since the last send, so it can be called on every
+    request. The socket never blocks: parts that can not be sent at once
+    are kept in `pending` and go with the next send, `delayed` counts them.
+    `address` is a path of a UNIX socket or a (host, port) of UDP.
+    """
+
+    DATAGRAM_SIZE = 60000  # under the limit of UDP
+
+    def __init__(self, profiler, address, interval=10., size=DATAGRAM_SIZE):
+        self.profiler = profiler
+        self.address = address
+        self.interval = interval
+        self.size = size
+        self.socket = socket.socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.sent = time.monotonic()
+        self.pending = Profiler()  # stats that are not sent yet
+        self.delayed = 0
+        self.lock = threading.Lock()
+        self.stopped = None
+        self.thread = None
+
+    def push(self, force=False):
+        """Swap and send a delta if the interval passed (or anyway with `force`); False if nothing or not all was sent.
+
+        Call it from the profiled thread: a stat swapped while its thread is
+        updating it would lose the update.
+        """
+        if not force and time.monotonic() - self.sent < self.interval:
+            return False
+        self.sent = time.monotonic()
+        delta = self.profiler.swap()
+        with self.lock:
+            self.pending.merge(delta)
+        return self.send()
+
+    def send(self):
+        """Send pending stats; False if not all were sent."""
+        with self.lock:
+            pending, self.pending = self.pending, Profiler()
+            ok = True
+            for part in pending.split(self.size):
+                if ok:
+                    try:
+                        self.socket.sendto(part.dumps(), self.address)
+                        continue
+                    except OSError:  # no collector, full buffer of the socket
+                        ok = False
+                self.delayed += 1
+                self.pending.merge(part)
+            return ok
+
+    def start(self):
+        """Resend pending stats every interval in a background thread, so they do not wait for the next push()."""
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='pprofiler-sender', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.send()
+
+    def close(self):
+        """Send the last delta and close the socket."""
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        self.push(force=True)
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class Collector(object):
+    """Receiver of DeltaSender datagrams, it merges them into one profiler.
+
+    `serve()` receives in a background thread; `snapshot()` returns a copy
+    of all stats merged so far, it has the usual `report` and `lines`.
+    Datagrams that are not dumps are counted in `errors`.
+    """
+
+    DATAGRAM_SIZE = 1 << 20
+
+    def __init__(self, address):
+        self.socket = socket.socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.address = self.socket.getsockname()
+        self.profiler = Profiler()
+        self.lock = threading.Lock()
+        self.received = 0
+        self.errors = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def receive(self, timeout=None):
+        """Receive and merge one datagram; False on timeout."""
+        self.socket.settimeout(timeout)
+        try:
+            data = self.socket.recv(self.DATAGRAM_SIZE)
+        except socket.timeout:
+            return False
+        try:
+            delta = Profiler.loads(data)  # a bad datagram must not be merged in part
+        except (ValueError, struct.error, IndexError):
+            with self.lock:
+                self.errors += 1
+            return True
+        with self.lock:
+            self.profiler.merge(delta)
+            self.received += 1
+        return True
+
+    def serve(self, poll=.1):
+        """Receive in a background thread; it checks for stop() every `poll` seconds."""
+        self.thread = threading.Thread(target=self.run, args=(poll,), name='pprofiler-collector', daemon=True)
+        self.thread.start()
+
+    def run(self, poll=.1):
+        while not self.stopped.is_set():
+            self.receive(poll)
+
+    def snapshot(self):
+        with self.lock:
+            return Profiler().merge(self.profiler)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        self.socket.close()
+        if isinstance(self.address, str) and self.address:
+            os.unlink(self.address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def dump_size(name, scope):
+    """Bytes of a scope in dumps(), no less than it takes; `scope` None is a scope without entries."""
+    r = DUMP_NODE.size + DUMP_NAME_LENGTH.size + len(name.encode('utf-8'))
+    if scope is None:
+        return r
+    s = scope.stat
+    if s.histogram is not None:
+        r += DUMP_BUCKET.size * sum(1 for c in s.histogram.counts if c)
+    if s.clocks is not None:
+        r += sum(DUMP_CLOCK.size + DUMP_NAME_LENGTH.size + len(k.encode('utf-8')) for k in s.clocks)
+    if scope.labels:
+        r += sum(DUMP_LABEL.size + DUMP_NAME_LENGTH.size + len(json.dumps(lk).encode('utf-8')) for lk in scope.labels)
+    return r
+
+
+def parse_address(address):
+    """'host:port' of UDP as a tuple, anything else is a path of a UNIX socket."""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return host, int(port)
+    return address
+
+
+EXEMPLAR_SEQUENCE = itertools.count()  # to order exemplars of the same duration
+
+
+def check_sample(sample):
+    """Sampling rate as given: None, an integer N >= 1 or a float 0 < p < 1; ValueError otherwise."""
+    if sample is None or (type(sample) is int and sample >= 1) or (type(sample) is float and 0 < sample < 1):
+        return sample
+    raise ValueError('pprofiler: sample must be an integer N >= 1 or a float 0 < p < 1, not {!r}'.format(sample))
+
+
+def shared_name(name):
+    """Name as it fits a slot of SharedStats."""
+    return name.encode('utf-8')[:SHARED_NAME_SIZE].decode('utf-8', 'ignore')
+
+
+def capture_stack(limit=EXEMPLAR_STACK):
+    """The last `limit` frames of the stack out of this module, as 'file:line function'."""
+    f = sys._getframe(1)
+    while f is not None and f.f_code.co_filename == __file__:
+        f = f.f_back
+    return ['{}:{} {}'.format(x.filename, x.lineno, x.name) for x in traceback.extract_stack(f, limit)]
+
+
+def labels_key(labels):
+    """Sorted tuple of (name, str value) pairs."""
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def label_scope(scope, labels, new_stat, *args):
+    """Scope of labels of the scope: LabelStat and the same nested scopes."""
+    if scope.labels is None:
+        scope.labels = {}
+    r = scope.labels.get(labels)
+    if r is None:
+        r = scope.labels[labels] = Scope(stat=LabelStat(scope, new_stat(*args)), scopes=scope.scopes)
+    return r
+
+
+def format_labels(labels):
+    return '[{}]'.format(', '.join('{}={}'.format(k, v) for k, v in labels))
+
+
+def start_extended(profiler):
+    """Start of a scope with extra clocks or events: wall time goes last to leave the reading of clocks out."""
+    r = [f() for f in profiler.clock_functions]
+    if profiler.memory is not None:
+        r.append(profiler.memory.enter())
+    r.append(time.perf_counter_ns())
+    return r
+
+
+def update_extended(profiler, scope, t, start):
+    """Exit of the scope; it is still the top of the profiler stack."""
+    if profiler.clocks:
+        vals = [f() - s for f, s in zip(profiler.clock_functions, start)]
+        if profiler.memory is not None:
+            vals.extend(profiler.memory.exit(start[-2]))
+        scope.stat.update_clocks(t - start[-1], vals)
+    else:
+        scope.stat.update(t - start[-1])
+    events = profiler.events
+    if events is not None and not events.record(scope, start[-1], t):
+        events.register(scope, stack_path(profiler.stack))
+        events.record(scope, start[-1], t)
+
+
+def stack_path(stack):
+    """Names of scopes of the stack; names are looked up in parents, it is for rare use."""
+    stack = [s.stat.scope if isinstance(s.stat, LabelStat) else s for s in stack]
+    return tuple(next(k for k, v in parent.scopes.items() if v is child) for parent, child in zip(stack, stack[1:]))
+
+
+def chrome_trace(events, pid):
+    """Chrome Trace Event format of (path, start, end, thread) events: complete events, timestamps in us."""
+    return {
+        'traceEvents': [{
+            'name': path[-1],
+            'cat': 'pprofiler',
+            'ph': 'X',
+            'ts': start / 1000,
+            'dur': (end - start) / 1000,
+            'pid': pid,
+            'tid': thread,
+            'args': {'path': '/'.join(path)},
+        } for path, start, end, thread in events],
+        'displayTimeUnit': 'ns',
+    }
+
+
+def speedscope(events, name='pprofiler'):
+    """speedscope file of (path, start, end, thread) events: evented profile per thread."""
+    frames = {}
+    threads = collections.defaultdict(list)
+    for path, start, end, thread in events:
+        f = frames.get(path[-1])
+        if f is None:
+            f = frames[path[-1]] = len(frames)
+        depth = len(path)
+        threads[thread].append((start, 1, depth, 'O', f))  # at the same time: close, then open; outer opens first
+        threads[thread].append((end, 0, -depth, 'C', f))
+    profiles = []
+    for thread, marks in sorted(threads.items()):
+        marks.sort()
+        profiles.append({
+            'type': 'evented',
+            'name': '{} thread {}'.format(name, thread),
+            'unit': 'nanoseconds',
+            'startValue': marks[0][0],
+            'endValue': marks[-1][0],
+            'events': [{'type': t, 'frame': f, 'at': at} for at, _, _, t, f in marks],
+        })
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'shared': {'frames': [{'name': k} for k in frames]},
+        'profiles': profiles,
+        'name': name,
+        'exporter': 'pprofiler {}'.format(__version__),
+    }
+
+
+def compensate_scope(scope, inner, outer):
+    """Copy of the tree with profiler own cost subtracted, and number of nested entries."""
+    root = Scope(stat=None, scopes={})
+    order = []  # parents go before children
+    stack = [(scope, root)]
+    while stack:
+        src, dst = stack.pop()
+        order.append((src, dst))
+        for k, v in list(src.scopes.items()):
+            c = dst.scopes[k] = Scope(stat=None, scopes={})
+            stack.append((v, c))
+    nested = {}
+    for src, dst in reversed(order):
+        calls = 0
+        for c in dst.scopes.values():
+            calls += nested[id(c)] + c.stat.n + c.stat.skipped
+        nested[id(dst)] = calls
+        if src.stat is not None:
+            dst.stat = compensate_stat(src.stat, calls, inner, outer)
+            dst.labels = src.labels  # stats of labels are not compensated
+    return root, nested[id(root)]
+
+
+def compensate_stat(s, calls, inner, outer):
+    r = Stat().merge(s)
+    if s.n > 0:
+        # nested entries happened in skipped entries too
+        cost = inner * s.n + outer * calls * s.n / (s.n + s.skipped)
+        cost = min(cost, s.sum)
+        shift = cost / s.n  # in average; keep deviation as is
+        r.sum = s.sum - cost
+        r.sum2 = s.sum2 - 2 * shift * s.sum + s.n * shift * shift
+        r.min = max(0, s.min - inner)
+        r.max = max(0, s.max - inner)
+    return r
+
+
+def swap_scopes(dst, src, new_stat):
+    stack = [(dst, src)]
+    while stack:
+        dst, src = stack.pop()
+        for k, v in list(src.items()):
+            stat, v.stat = v.stat, keep_window(v.stat, new_stat(k))
+            d = dst[k] = Scope(stat=stat, scopes={})
+            if v.labels:
+                for lk, lv in list(v.labels.items()):
+                    stat, lv.stat.stat = lv.stat.stat, keep_window(lv.stat.stat, new_stat(k, False))
+                    label_scope(d, lk, Stat).stat.stat = stat
+            if v.scopes:
+                stack.append((d.scopes, v.scopes))
+
+
+def keep_window(old, new):
+    """The new stat of a swap takes over the ring of recent intervals."""
+    if isinstance(old, WindowStat) and isinstance(new, WindowStat):
+        new.buckets, new.epochs = old.buckets, old.epochs
+    return new
+
+
+def window_stat(stat, seconds, now):
+    """Stats merged from other profilers have no time, they are in no window."""
+    return stat.window(seconds, now) if isinstance(stat, WindowStat) else Stat()
+
+
+def window_scopes(dst, src, seconds, now):
+    stack = [(dst, src)]
+    while stack:
+        dst, src = stack.pop()
+        for k, v in list(src.items()):
+            d = dst[k] = Scope(stat=window_stat(v.stat, seconds, now), scopes={})
+            if v.labels:
+                for lk, lv in list(v.labels.items()):
+                    label_scope(d, lk, Stat).stat.stat = window_stat(lv.stat.stat, seconds, now)
+            if v.scopes:
+                stack.append((d.scopes, v.scopes))
+
+
+def subtract_scopes(dst, src):
+    stack = [(dst, src)]
+    while stack:
+        dst, src = stack.pop()
+        for k, v in list(src.items()):
+            d = dst.get(k)
+            if d is not None:
+                d.stat = d.stat - v.stat
+                if d.labels and v.labels:
+                    for lk, lv in list(v.labels.items()):
+                        dl = d.labels.get(lk)
+                        if dl is not None:
+                            dl.stat.stat = dl.stat.stat - lv.stat.stat
+                if v.scopes:
+                    stack.append((d.scopes, v.scopes))
+
+
+def merge_scopes(dst, src):
+    stack = [(dst, src)]
+    while stack:
+        dst, src = stack.pop()
+        for k, v in list(src.items()):
+            d = dst.get(k)
+            if d is None:
+                d = dst[k] = Scope(stat=Stat(), scopes={})
+            merge_scope(d, v)
+            if v.scopes:
+                stack.append((d.scopes, v.scopes))
+
+
+def merge_scope(dst, src):
+    """Merge the stat and labels of one scope, not nested scopes."""
+    dst.stat.merge(src.stat)
+    if src.labels:
+        for lk, lv in list(src.labels.items()):
+            label_scope(dst, lk, Stat).stat.stat.merge(lv.stat.stat)
+
+
+def fold_scopes(scopes, weight):
+    path = []
+    stack = [iter(list(scopes.items()))]
+    while stack:
+        for name, scope in stack[-1]:
+            del path[len(stack) - 1:]
+            path.append(name.replace(';', ':').replace('\n', ' '))
+            s = scope.stat
+            if weight == 'count':
+                v = s.n + s.skipped
+            else:
+                v = estimated_sum(s)
+                if weight == 'self':
+                    v = max(0, v - sum(estimated_sum(c.stat) for c in scope.scopes.values()))
+            if v > 0:
+                yield '{} {:.0f}'.format(';'.join(path), v)
+            if scope.scopes:
+                stack.append(iter(list(scope.scopes.items())))
+            break
+        else:
+            stack.pop()
+
+
+class NameStat(object):
+
+    __slots__ = ('stat', 'self', 'callers', 'callees')
+
+    def __init__(self):
+        self.stat = Stat()
+        self.self = 0
+        self.callers = collections.defaultdict(Stat)
+        self.callees = collections.defaultdict(Stat)
+
+
+def names_to_report(scopes, ticks=1):
+    """Rows of stats merged by name; callers and callees are stats of the edges.
+
+    Like in pstats, an entry nested in an entry of the same name (recursion)
+    is not added to the stat of the name again, but it is added to its self
+    time and to the edges.
+    """
+    names = {}
+    path = []
+    active = collections.Counter()  # names of the path
+    stack = [iter(list(scopes.items()))]
+    while stack:
+        for name, scope in stack[-1]:
+            n = names.get(name)
+            if n is None:
+                n = names[name] = NameStat()
+            if not active[name]:
+                n.stat.merge(scope.stat)
+            n.self += max(0, estimated_sum(scope.stat) - sum(estimated_sum(c.stat) for c in scope.scopes.values()))
+            if path:
+                n.callers[path[-1]].merge(scope.stat)
+                names[path[-1]].callees[name].merge(scope.stat)
+            if scope.scopes:
+                path.append(name)
+                active[name] += 1
+                stack.append(iter(list(scope.scopes.items())))
+            break
+        else:
+            stack.pop()
+            if path:
+                active[path.pop()] -= 1
+    r = []
+    for name, n in names.items():
+        s = scale_stat(n.stat.stat, ticks)
+        s['name'] = name
+        s['self'] = n.self / ticks
+        for k, edges in (('callers', n.callers), ('callees', n.callees)):
+            s[k] = []
+            for e, stat in edges.items():
+                c = scale_stat(stat.stat, ticks)
+                c['name'] = e
+                s[k].append(c)
+            s[k].sort(key=lambda x: x['sum'], reverse=True)
+        if s['num'] > 0 or s['callees']:
+            r.append(s)
+    r.sort(key=lambda x: x['sum'], reverse=True)
+    return r
+
+
+def estimated_sum(s):
+    if s.skipped and s.n:
+        return s.sum * (s.n + s.skipped) / s.n
+    return s.sum
+
+
 def report_to_flat(nodes):
-    stack = []
-    while stack or nodes:
-        n = nodes.pop(0)
-        n['level'] = len(stack)
-        subscope = n.pop(SUBSCOPE_NAME, None)
-        yield n
-        if subscope:
-            stack.append(nodes)
-            nodes = subscope
-        while len(nodes) == 0 and len(stack) > 0:
-            nodes = stack.pop()
-
-
-def scopes_to_report(scopes):
+    """Flat rows of nested report; the report is left as is."""
+    stack = [iter(nodes)]
+    while stack:
+        for n in stack[-1]:
+            r = {k: v for k, v in n.items() if k != SUBSCOPE_NAME}
+            r['level'] = len(stack) - 1
+            yield r
+            if n.get(SUBSCOPE_NAME):
+                stack.append(iter(n[SUBSCOPE_NAME]))
+            break
+        else:
+            stack.pop()
+
+
+def scale_stat(s, ticks):
+    for k in SCALED_FIELDS:
+        if s.get(k) is not None:
+            s[k] = s[k] / ticks
+    return s
+
+
+def scopes_to_report(scopes, ticks=1, top=None, unaccounted=False, by_labels=False):
+    r = []
+    stack = [r]
+    for level, row in walk_report(scopes, ticks, top, unaccounted, by_labels):
+        del stack[level + 1:]
+        if level == len(stack):  # the first child of the previous row
+            stack.append(stack[-1][-1].setdefault(SUBSCOPE_NAME, []))
+        stack[level].append(row)
+    return r
+
+
+def walk_report(scopes, ticks=1, top=None, unaccounted=False, by_labels=False):
+    """Yield (level, row) of report depth first, without recursion.
+
+    Every scope is visited once; rows are built level by level, when the
+    walk comes to them. Self time of a row is its sum without sums of
+    nested scopes, `unaccounted` shows it as a row among nested scopes.
+    `by_labels` adds rows of labels right after the row of the scope, one
+    level deeper.
+    """
+    memo = {}
+    total = sum(estimated_sum(v.stat) for v in scopes.values()) / ticks
+    stack = [iter(report_level(scopes, ticks, top, memo, total))]
+    while stack:
+        for row, scope in stack[-1]:
+            yield len(stack) - 1, row
+            if scope is None:
+                break
+            if by_labels and scope.labels:
+                for r in labels_report(scope, row, ticks, total):
+                    yield len(stack), r
+            if scope.scopes:
+                stack.append(iter(report_level(scope.scopes, ticks, top, memo, total, row if unaccounted else None)))
+            break
+        else:
+            stack.pop()
+
+
+def report_level(scopes, ticks, top, memo, total, parent=None):
     r = []
     a = 0.
-    for k, v in scopes.items():
-        s = v.stat.stat
+    for k, v in list(scopes.items()):
+        s = scale_stat(v.stat.stat, ticks)
         s['name'] = k
-        if v.scopes:
-            sub_scopes = scopes_to_report(v.scopes)
-            if len(sub_scopes) > 0:
-                s[SUBSCOPE_NAME] = sub_scopes
-        r.append(s)
+        s['self'] = max(0., s['sum'] - sum(estimated_sum(c.stat) for c in v.scopes.values()) / ticks)  # scopes can be open
         a += s['sum']
-    if a > 0:
-        p = lambda x: 100 * x['sum'] / a
+        if s['num'] > 0 or has_data(v.scopes, memo):
+            r.append((s, v))
+    if r and parent is not None and parent['self'] > 0:
+        s = unaccounted_stat(parent)
+        a += s['sum']
+        r.append((s, None))
+    for s, _ in r:
+        s['percent'] = 100 * s['sum'] / a if a > 0 else 0.
+        s['root_percent'] = 100 * s['sum'] / total if total > 0 else 0.
+    if top is None:
+        r.sort(key=lambda x: x[0]['sum'], reverse=True)
     else:
-        p = lambda x: 0.
-    for i in r:
-        i['percent'] = p(i)
-    r = [x for x in r if x['num'] > 0 or len(x.get(SUBSCOPE_NAME, [])) > 0]
+        r = heapq.nlargest(top, r, key=lambda x: x[0]['sum'])
+    return r
+
+
+def labels_report(scope, row, ticks, total):
+    """Rows of labels of the scope, percent is a share of the scope."""
+    r = []
+    for labels, v in list(scope.labels.items()):
+        s = scale_stat(v.stat.stat.stat, ticks)
+        s['name'] = format_labels(labels)
+        s['labels'] = dict(labels)
+        s['self'] = None
+        s['percent'] = 100 * s['sum'] / row['sum'] if row['sum'] > 0 else 0.
+        s['root_percent'] = 100 * s['sum'] / total if total > 0 else 0.
+        r.append(s)
     r.sort(key=lambda x: x['sum'], reverse=True)
     return r
 
 
+def unaccounted_stat(parent):
+    return {
+        'name': UNACCOUNTED_SCOPE,
+        'sum': parent['self'],
+        'self': parent['self'],
+        'num': parent['num'],
+        'avg': parent['self'] / parent['num'] if parent['num'] > 0 else None,
+        'dev': None,
+        'min': None,
+        'max': None,
+    }
+
+
+def has_data(scopes, memo):
+    """Whether any scope of the tree has entries; memo keeps answers, so every scope is checked once."""
+    if id(scopes) in memo:
+        return memo[id(scopes)]
+    path = [(scopes, iter(list(scopes.values())))]
+    while path:
+        for v in path[-1][1]:
+            if v.stat.n > 0 or v.stat.skipped > 0 or memo.get(id(v.scopes)):
+                for p, _ in path:
+                    memo[id(p)] = True
+                return True
+            if v.scopes and id(v.scopes) not in memo:
+                path.append((v.scopes, iter(list(v.scopes.values()))))
+                break
+        else:
+            memo[id(path.pop()[0])] = False
+    return False
+
+
 profiler = Profiler()
+
+
+def main(argv=None):
+    """Collector of deltas: python -m pprofiler ADDRESS, ADDRESS is host:port of UDP or a path of a UNIX socket."""
+    parser = argparse.ArgumentParser(prog='pprofiler', description='Collect deltas of DeltaSender and print merged reports.')
+    parser.add_argument('address', help='host:port of UDP or a path of a UNIX socket')
+    parser.add_argument('--interval', type=float, default=60., help='seconds between reports')
+    args = parser.parse_args(argv)
+    with Collector(parse_address(args.address)) as collector:
+        collector.serve()
+        std_print('collecting at {}'.format(collector.address), flush=True)
+        try:
+            while True:
+                time.sleep(args.interval)
+                collector.snapshot().print_report()
+                std_print(flush=True)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
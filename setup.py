@@ -3,7 +3,7 @@
 
 import re
 
-from distutils.core import setup
+from setuptools import setup
 
 
 mod_name = 'pprofiler'
@@ -27,5 +27,6 @@ setup(
     description='Python code level profiler',
     long_description='Python code level profiler with nested scopes',
     platforms=['any'],
+    python_requires='>=3.8',  # asyncio syntax, contextvars, multiprocessing.shared_memory
     license='MIT License',
 )
@@ -12,10 +12,21 @@ class FakeTimer(object):
 
    def __init__(self, start_time):
        self.wallclock = float(start_time)
+       self.cpu = 0.
+
+   def work(self, seconds):
+       self.wallclock += seconds
+       self.cpu += seconds
+
+   def process_time_ns(self):
+       return int(round(self.cpu * 1e9))
 
    def time(self):
        return self.wallclock
 
+   def perf_counter_ns(self):
+       return int(round(self.wallclock * 1e9))
+
    def sleep(self, seconds):
        self.wallclock += seconds
 
@@ -36,7 +47,11 @@ class FakeLogger(object):
 def fake_timer(monkeypatch):
     faketimer = FakeTimer(1000)
     monkeypatch.setattr(pprofiler.time, 'time', faketimer.time)
+    monkeypatch.setattr(pprofiler.time, 'perf_counter_ns', faketimer.perf_counter_ns)
+    monkeypatch.setattr(pprofiler.time, 'process_time_ns', faketimer.process_time_ns)
+    monkeypatch.setattr(pprofiler.time, 'thread_time_ns', faketimer.process_time_ns)
     monkeypatch.setattr(time, 'sleep', faketimer.sleep)
+    return faketimer
 
 
 @pytest.fixture
@@ -0,0 +1,87 @@
+# coding: U8
+
+
+import asyncio
+import inspect
+import time
+
+import pytest
+
+from pprofiler import AsyncProfiler
+
+
+def test_tasks_do_not_nest(fake_timer):
+    local_profiler = AsyncProfiler()
+
+    async def task_a():
+        async with local_profiler('a'):
+            await asyncio.sleep(0)  # let task_b enter its scope
+            time.sleep(2)
+            await asyncio.sleep(0)
+
+    async def task_b():
+        async with local_profiler('b'):
+            time.sleep(1)
+
+    async def main():
+        await asyncio.gather(task_a(), task_b())
+
+    asyncio.run(main())
+    assert local_profiler.is_complete
+    assert [(r['name'], r['level'], r['sum']) for r in local_profiler] == [
+        ('a', 0, pytest.approx(3.)),
+        ('b', 0, pytest.approx(1.)),
+    ]
+
+
+def test_nested_in_task(fake_timer):
+    local_profiler = AsyncProfiler()
+
+    async def task(name):
+        async with local_profiler('request'):
+            await asyncio.sleep(0)
+            async with local_profiler(name):
+                time.sleep(1)
+                await asyncio.sleep(0)
+
+    async def main():
+        await asyncio.gather(task('x'), task('y'))
+
+    asyncio.run(main())
+    assert [(r['name'], r['level'], r['num']) for r in local_profiler] == [
+        ('request', 0, 2),
+        ('x', 1, 1),
+        ('y', 1, 1),
+    ]
+
+
+def test_async_decorator(fake_timer):
+    local_profiler = AsyncProfiler()
+
+    @local_profiler('handler')
+    async def handler(t):
+        await asyncio.sleep(0)
+        time.sleep(t)
+        return t
+
+    assert inspect.iscoroutinefunction(handler)
+
+    async def main():
+        return await asyncio.gather(handler(1), handler(2))
+
+    assert asyncio.run(main()) == [1, 2]
+    assert [(r['name'], r['num'], r['min'], r['max']) for r in local_profiler] == [
+        ('handler', 2, pytest.approx(1.), pytest.approx(3.)),  # both awaited bodies overlap the sleep(1)
+    ]
+
+
+def test_not_complete_while_task_is_open():
+    local_profiler = AsyncProfiler()
+
+    async def main():
+        async with local_profiler('x'):
+            assert local_profiler.is_complete is False
+            assert [s is not None for s in local_profiler.stack] == [True, True]
+        assert local_profiler.is_complete is True
+
+    asyncio.run(main())
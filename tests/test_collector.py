@@ -0,0 +1,156 @@
+# coding: U8
+
+
+import multiprocessing
+import time
+
+import pytest
+
+from pprofiler import profiler, Collector, DeltaSender, parse_address
+
+
+def collector_process(address, conn):
+    with Collector(address) as collector:
+        collector.serve()
+        conn.send(collector.address)
+        while conn.recv():
+            conn.send(collector.snapshot().dumps())
+
+
+def wait_report(get_report, expected):
+    deadline = time.monotonic() + 10
+    while True:
+        report = sorted((r['name'], r['level'], r['num']) for r in get_report())
+        if report == expected or time.monotonic() > deadline:
+            return report
+        time.sleep(.01)
+
+
+@pytest.fixture(params=['unix', 'udp'])
+def collector_address(request, tmp_path):
+    if request.param == 'unix':
+        return str(tmp_path / 'collector.sock')
+    return ('127.0.0.1', 0)
+
+
+def test_collector(collector_address):
+    conn, child_conn = multiprocessing.Pipe()
+    p = multiprocessing.Process(target=collector_process, args=(collector_address, child_conn))
+    p.start()
+
+    def get_report():
+        conn.send(True)
+        return type(profiler).loads(conn.recv())
+
+    try:
+        assert conn.poll(10)
+        collector_address = conn.recv()  # a free port is chosen by the collector
+        local_profilers = [type(profiler)(), type(profiler)(percentiles=True)]
+        senders = [DeltaSender(local_profiler, collector_address) for local_profiler in local_profilers]
+        for _ in range(2):
+            for local_profiler, sender in zip(local_profilers, senders):
+                with local_profiler('a'):
+                    with local_profiler('b'):
+                        pass
+                assert sender.push() is False  # the interval has not passed
+                assert sender.push(force=True) is True
+        with local_profilers[1]('big'):
+            for i in range(1500):
+                with local_profilers[1]('scope {:04d}'.format(i)):
+                    pass
+        assert len(local_profilers[1].snapshot().dumps()) > DeltaSender.DATAGRAM_SIZE
+        for sender in senders:
+            sender.close()
+        expected = [('a', 0, 4), ('b', 1, 4), ('big', 0, 1)] + [('scope {:04d}'.format(i), 1, 1) for i in range(1500)]
+        assert wait_report(get_report, expected) == expected
+        assert all(sender.delayed == 0 for sender in senders)
+    finally:
+        conn.send(False)
+        p.join()
+
+
+def test_split(fake_timer):
+    local_profiler = type(profiler)(percentiles=True)
+    for i in range(300):
+        with local_profiler('p {}'.format(i % 3)):
+            with local_profiler('q'):
+                with local_profiler('r {}'.format(i), kind=str(i % 2)):
+                    time.sleep(i)
+    parts = local_profiler.split(2000)
+    assert len(parts) > 1
+    assert all(len(part.dumps()) <= 2000 for part in parts)
+    merged = type(profiler)()
+    for part in parts:
+        merged.merge_bytes(part.dumps())
+    whole = type(profiler).loads(local_profiler.dumps())  # dumps do not keep the percentiles of labels
+    merged.by_labels = whole.by_labels = True
+    assert merged.report == whole.report
+    assert local_profiler.split(10)[0].report[0]['name'] == 'p 0'  # a scope that does not fit makes a part alone
+
+
+def test_collector_not_reading(tmp_path):
+    address = str(tmp_path / 'collector.sock')
+    local_profiler = type(profiler)()
+    with DeltaSender(local_profiler, address) as sender:
+        with local_profiler('a'):
+            pass
+        assert sender.push(force=True) is False  # no collector at all
+        assert sender.delayed == 1
+        with Collector(address) as collector:  # it does not read, the queue of the socket gets full
+            for _ in range(1000):
+                with local_profiler('a'):
+                    pass
+                sender.push(force=True)
+            assert sender.delayed > 1
+            collector.serve()
+            while sender.push(force=True) is False:  # delayed, not lost
+                time.sleep(.01)
+            assert wait_report(collector.snapshot, [('a', 0, 1001)]) == [('a', 0, 1001)]
+
+
+def test_sender_thread(tmp_path):
+    address = str(tmp_path / 'collector.sock')
+    local_profiler = type(profiler)()
+    with Collector(address) as collector:
+        collector.serve()
+        with DeltaSender(local_profiler, address, interval=.0005) as sender:
+            sender.start()
+            for i in range(200000):
+                with local_profiler('a'):
+                    with local_profiler('b'):
+                        pass
+                if i % 1000 == 0:
+                    sender.push()
+        expected = [('a', 0, 200000), ('b', 1, 200000)]
+        assert wait_report(collector.snapshot, expected) == expected
+        assert collector.errors == 0
+
+
+def test_collector_errors(tmp_path):
+    address = str(tmp_path / 'collector.sock')
+    with Collector(address) as collector:
+        collector.socket.sendto(b'garbage', address)
+        assert collector.receive(1) is True
+        assert collector.receive(.01) is False
+        assert (collector.received, collector.errors) == (0, 1)
+        local_profiler = type(profiler)()
+        with local_profiler('a'):
+            pass
+        with local_profiler('b', k='v'):
+            pass
+        data = local_profiler.dumps()
+        assert b'[["k", "v"]]' in data
+        collector.socket.sendto(data.replace(b'[["k", "v"]]', b'[1234567890]'), address)  # JSON, but not labels
+        assert collector.receive(1) is True
+        assert (collector.received, collector.errors) == (0, 2)
+        assert list(collector.snapshot()) == []  # not merged in part
+
+
+@pytest.mark.parametrize('address, expected', [
+    ('127.0.0.1:9999', ('127.0.0.1', 9999)),
+    ('localhost:1', ('localhost', 1)),
+    ('/tmp/pprofiler.sock', '/tmp/pprofiler.sock'),
+    ('./a:1', './a:1'),
+])
+def test_parse_address(address, expected):
+    assert parse_address(address) == expected
@@ -0,0 +1,81 @@
+# coding: U8
+
+
+import json
+import threading
+import time
+
+import pytest
+
+from pprofiler import profiler, ThreadProfiler
+
+
+def run(local_profiler):
+    with local_profiler('a'):
+        with local_profiler('b'):
+            time.sleep(1)
+        with local_profiler('b'):
+            time.sleep(2)
+    with local_profiler('c'):
+        time.sleep(1)
+
+
+def test_events(fake_timer):
+    local_profiler = type(profiler)(events=10)
+    run(local_profiler)
+    tid = threading.get_ident()
+    assert list(local_profiler.trace_events()) == [
+        (('a', 'b'), 1000000000000, 1001000000000, tid),
+        (('a', 'b'), 1001000000000, 1003000000000, tid),
+        (('a',), 1000000000000, 1003000000000, tid),
+        (('c',), 1003000000000, 1004000000000, tid),
+    ]
+    assert local_profiler.events.lost == 0
+
+
+@pytest.mark.parametrize('overflow, names', [
+    ('overwrite', [('a', 'b'), ('a',), ('c',)]),  # the latest events
+    ('drop', [('a', 'b'), ('a', 'b'), ('a',)]),  # the first events
+])
+def test_overflow(fake_timer, overflow, names):
+    local_profiler = type(profiler)(events=3, overflow=overflow)
+    run(local_profiler)
+    assert [e[0] for e in local_profiler.trace_events()] == names
+    assert local_profiler.events.lost == 1
+    assert [(r['name'], r['num']) for r in local_profiler] == [('a', 1), ('b', 2), ('c', 1)]  # stats are complete
+
+
+def test_events_not_enabled():
+    with pytest.raises(RuntimeError):
+        type(profiler)().chrome_trace()
+
+
+def test_chrome_trace(fake_timer):
+    local_profiler = type(profiler)(events=10)
+    run(local_profiler)
+    trace = json.loads(json.dumps(local_profiler.chrome_trace()))
+    assert [(e['name'], e['ph'], e['ts'], e['dur'], e['args']['path']) for e in trace['traceEvents']] == [
+        ('b', 'X', 1000000000., 1000000., 'a/b'),
+        ('b', 'X', 1001000000., 2000000., 'a/b'),
+        ('a', 'X', 1000000000., 3000000., 'a'),
+        ('c', 'X', 1003000000., 1000000., 'c'),
+    ]
+
+
+def test_speedscope(fake_timer):
+    local_profiler = ThreadProfiler(events=10)
+    run(local_profiler)
+    doc = json.loads(json.dumps(local_profiler.speedscope()))
+    assert [f['name'] for f in doc['shared']['frames']] == ['b', 'a', 'c']
+    profile, = doc['profiles']
+    assert (profile['type'], profile['unit'], profile['startValue'], profile['endValue']) == ('evented', 'nanoseconds', 1000000000000, 1004000000000)
+    assert [(e['type'], e['frame'], e['at'] - 1000000000000) for e in profile['events']] == [
+        ('O', 1, 0),
+        ('O', 0, 0),
+        ('C', 0, 1000000000),
+        ('O', 0, 1000000000),
+        ('C', 0, 3000000000),
+        ('C', 1, 3000000000),
+        ('O', 2, 3000000000),
+        ('C', 2, 4000000000),
+    ]
@@ -0,0 +1,138 @@
+# coding: U8
+
+
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from pprofiler import profiler, OpenMetricsExporter, ThreadProfiler
+
+
+def test_openmetrics(fake_timer):
+    local_profiler = type(profiler)()
+    with local_profiler('a'):
+        with local_profiler('b "1"'):
+            time.sleep(1)
+        with local_profiler('b "1"'):
+            time.sleep(2)
+    assert OpenMetricsExporter(local_profiler, max_age=0).render() == '''# TYPE pprofiler_scope_calls counter
+# HELP pprofiler_scope_calls Number of scope entries.
+pprofiler_scope_calls_total{scope="a"} 1
+pprofiler_scope_calls_total{scope="a/b \\"1\\""} 2
+# TYPE pprofiler_scope_seconds counter
+# HELP pprofiler_scope_seconds Total time in scope.
+pprofiler_scope_seconds_total{scope="a"} 3.0
+pprofiler_scope_seconds_total{scope="a/b \\"1\\""} 3.0
+# TYPE pprofiler_scope_min_seconds gauge
+# HELP pprofiler_scope_min_seconds The shortest time in scope.
+pprofiler_scope_min_seconds{scope="a"} 3.0
+pprofiler_scope_min_seconds{scope="a/b \\"1\\""} 1.0
+# TYPE pprofiler_scope_max_seconds gauge
+# HELP pprofiler_scope_max_seconds The longest time in scope.
+pprofiler_scope_max_seconds{scope="a"} 3.0
+pprofiler_scope_max_seconds{scope="a/b \\"1\\""} 2.0
+# TYPE pprofiler_scope_duration_seconds histogram
+# HELP pprofiler_scope_duration_seconds Time in scope.
+# EOF
+'''
+
+
+def test_openmetrics_histogram(fake_timer):
+    local_profiler = type(profiler)(percentiles=True)
+    for t in (.001, .002, 1, 100):
+        with local_profiler('x'):
+            time.sleep(t)
+    text = OpenMetricsExporter(local_profiler).render()
+    buckets = [l for l in text.splitlines() if l.startswith('pprofiler_scope_duration_seconds_bucket')]
+    assert buckets[0] == 'pprofiler_scope_duration_seconds_bucket{scope="x",le="1.024e-06"} 0'
+    assert [int(l.split()[-1]) for l in buckets] == [0] * 5 + [1, 2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4]
+    assert buckets[-1] == 'pprofiler_scope_duration_seconds_bucket{scope="x",le="+Inf"} 4'
+    assert 'pprofiler_scope_duration_seconds_count{scope="x"} 4' in text
+    assert 'pprofiler_scope_duration_seconds_sum{scope="x"} 101.003' in text
+
+
+def test_openmetrics_cache(fake_timer, monkeypatch):
+    local_profiler = type(profiler)()
+    with local_profiler('a'):
+        time.sleep(1)
+    with local_profiler('b'):
+        time.sleep(1)
+    exporter = OpenMetricsExporter(local_profiler, max_age=0)
+    rendered = []
+    render_scope = exporter.render_scope
+    monkeypatch.setattr(exporter, 'render_scope', lambda path, stat: rendered.append(path) or render_scope(path, stat))
+    exporter.render()
+    assert sorted(rendered) == [('a',), ('b',)]
+    with local_profiler('b'):
+        time.sleep(1)
+    second = exporter.render()
+    assert sorted(rendered) == [('a',), ('b',), ('b',)]  # only changed scope
+    assert 'pprofiler_scope_calls_total{scope="b"} 2' in second
+    exporter.max_age = 60
+    with local_profiler('b'):
+        time.sleep(1)
+    assert exporter.render() is second  # too fresh to look at the tree
+
+
+def test_openmetrics_cache_swap(fake_timer):
+    local_profiler = type(profiler)()
+    with local_profiler('a'):
+        time.sleep(1)
+    exporter = OpenMetricsExporter(local_profiler, max_age=0)
+    assert 'pprofiler_scope_seconds_total{scope="a"} 1.0' in exporter.render()
+    local_profiler.swap()
+    with local_profiler('a'):  # the same number of entries in the new stat
+        time.sleep(2)
+    assert 'pprofiler_scope_seconds_total{scope="a"} 2.0' in exporter.render()
+
+
+def test_openmetrics_serve():
+    local_profiler = type(profiler)()
+    with local_profiler('x'):
+        pass
+    exporter = OpenMetricsExporter(local_profiler)
+    host, port = exporter.serve()
+    try:
+        with urllib.request.urlopen('http://{}:{}/metrics'.format(host, port)) as r:
+            assert r.headers['Content-Type'].startswith('application/openmetrics-text')
+            assert 'pprofiler_scope_calls_total{scope="x"} 1' in r.read().decode('utf-8')
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen('http://{}:{}/'.format(host, port))
+    finally:
+        exporter.stop()
+
+
+def test_openmetrics_cache_threads(fake_timer, monkeypatch):
+    local_profiler = ThreadProfiler()
+
+    def worker():
+        for name in ('a', 'b'):
+            with local_profiler(name):
+                time.sleep(1)
+
+    for _ in range(2):
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+    exporter = OpenMetricsExporter(local_profiler, max_age=0)
+    rendered = []
+    render_scope = exporter.render_scope
+    monkeypatch.setattr(exporter, 'render_scope', lambda path, stat: rendered.append(path) or render_scope(path, stat))
+    assert 'pprofiler_scope_calls_total{scope="a"} 2' in exporter.render()
+    assert sorted(rendered) == [('a',), ('b',)]
+    exporter.render()
+    assert sorted(rendered) == [('a',), ('b',)]  # trees of threads are not changed
+    worker()
+    assert 'pprofiler_scope_calls_total{scope="b"} 3' in exporter.render()
+    assert sorted(rendered) == [('a',), ('a',), ('b',), ('b',)]
+
+
+def test_http_server_not_imported():
+    code = 'import sys, pprofiler; sys.exit("http.server" in sys.modules)'
+    assert subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).returncode == 0
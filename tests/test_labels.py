@@ -0,0 +1,150 @@
+# coding: U8
+
+
+import time
+
+import pytest
+
+import pprofiler
+from pprofiler import profiler, ThreadProfiler, OpenMetricsExporter
+
+
+def run(local_profiler):
+    with local_profiler('request'):
+        for table, t in (('users', 1), ('users', 2), ('orders', 4)):
+            with local_profiler('db query', table=table):
+                time.sleep(t)
+        with local_profiler('db query'):
+            time.sleep(1)
+
+
+def test_collapsed(fake_timer):
+    local_profiler = type(profiler)()
+    run(local_profiler)
+    assert [(r['name'], r['level'], r['num'], r['sum']) for r in local_profiler] == [
+        ('request', 0, 1, pytest.approx(8.)),
+        ('db query', 1, 4, pytest.approx(8.)),
+    ]
+
+
+def test_by_labels(fake_timer, fake_logger):
+    local_profiler = type(profiler)()
+    local_profiler.by_labels = True
+    run(local_profiler)
+    local_profiler.print_report(fake_logger)
+    assert fake_logger.lines() == [
+        'name                   perc root%   sum  self  n   avg   max   min   dev',
+        '--------------------- ----- ----- ----- ----- -- ----- ----- ----- -----',
+        'request .............  100%  100%  8.00  0.00  1  8.00  8.00  8.00     -',
+        '. db query ..........  100%  100%  8.00  8.00  4  2.00  4.00  1.00  1.41',
+        '. . [table=orders] ..   50%   50%  4.00     -  1  4.00  4.00  4.00     -',
+        '. . [table=users] ...   38%   38%  3.00     -  2  1.50  2.00  1.00  0.71']
+    assert [r.get('labels') for r in local_profiler] == [None, None, {'table': 'orders'}, {'table': 'users'}]
+
+
+def test_interned(fake_timer):
+    local_profiler = type(profiler)()
+    a = local_profiler('x', table='users', shard=1)
+    b = local_profiler('x', shard='1', table='users')
+    assert a.labels is b.labels
+    assert a.labels == (('shard', '1'), ('table', 'users'))
+    assert local_profiler('x', table='users', shard='1').labels is a.labels  # cached by the given order
+    assert local_profiler('x', flag=1).labels == (('flag', '1'),)
+    assert local_profiler('x', flag=True).labels == (('flag', 'True'),)
+    assert type(profiler)()('x', table='users', shard=1).labels is not a.labels  # interned by profiler
+
+
+@pytest.mark.parametrize('name', ['scope', 'le', '__name', 'a b', '1a', 'ä'])
+def test_bad_label_names(name):
+    with pytest.raises(ValueError):
+        type(profiler)()('x', **{name: 'y'})
+
+
+def test_interned_bounded(fake_timer, monkeypatch):
+    monkeypatch.setattr(pprofiler, 'MAX_INTERNED', 10)
+    local_profiler = type(profiler)()
+    for i in range(100):
+        local_profiler('x', user=str(i))
+    assert len(local_profiler.interned) <= 11
+
+
+def test_labels_limits(fake_timer):
+    local_profiler = type(profiler)(max_children=2, max_scopes=3)
+    local_profiler.by_labels = True
+    for i in range(1000):
+        with local_profiler('x', user=i % 5):
+            pass
+    assert sorted((r['name'], r['num']) for r in local_profiler) == [
+        ('[labels=<other>]', 600), ('[user=0]', 200), ('[user=1]', 200), ('x', 1000)]
+    assert local_profiler.dropped == 600
+    local_profiler = type(profiler)(max_labels=1, max_scopes=3)
+    for i in range(3):
+        with local_profiler('x', user=i):
+            with local_profiler('y', user=i):
+                pass
+    assert local_profiler.dropped == 5
+    assert local_profiler.scopes_number == 3  # x, y and a label of x; labels of y are over max_scopes
+
+
+def test_decorator(fake_timer):
+    local_profiler = type(profiler)()
+    local_profiler.by_labels = True
+
+    @local_profiler('f', kind='slow')
+    def f():
+        time.sleep(2)
+
+    f()
+    f()
+    assert [(r['name'], r['num']) for r in local_profiler] == [('f', 2), ('[kind=slow]', 2)]
+
+
+def test_merge_dumps_swap(fake_timer):
+    local_profiler = type(profiler)()
+    run(local_profiler)
+    restored = type(profiler).loads(local_profiler.dumps())
+    merged = type(profiler)().merge(local_profiler, restored)
+    swapped = local_profiler.swap()
+    run(local_profiler)
+    for p in (restored, merged, swapped):
+        p.by_labels = True
+    expected = [('request', 1), ('db query', 4), ('[table=orders]', 1), ('[table=users]', 2)]
+    assert [(r['name'], r['num']) for r in restored] == expected
+    assert [(r['name'], r['num'] // 2) for r in merged] == expected
+    assert [(r['name'], r['num']) for r in swapped] == expected
+
+
+def test_threads(fake_timer):
+    local_profiler = ThreadProfiler()
+    local_profiler.by_labels = True
+    run(local_profiler)
+    assert [(r['name'], r['num']) for r in local_profiler] == [('request', 1), ('db query', 4), ('[table=orders]', 1), ('[table=users]', 2)]
+
+
+def test_events(fake_timer):
+    local_profiler = type(profiler)(events=10)
+    run(local_profiler)
+    assert [e[0] for e in local_profiler.trace_events()] == [('request', 'db query')] * 4 + [('request',)]
+
+
+def test_open_metrics(fake_timer):
+    local_profiler = type(profiler)()
+    run(local_profiler)
+    text = OpenMetricsExporter(local_profiler).render()
+    assert [l for l in text.splitlines() if l.startswith('pprofiler_scope_calls_total')] == [
+        'pprofiler_scope_calls_total{scope="request"} 1',
+        'pprofiler_scope_calls_total{scope="request/db query",table="users"} 2',
+        'pprofiler_scope_calls_total{scope="request/db query",table="orders"} 1',
+        'pprofiler_scope_calls_total{scope="request/db query"} 1',  # entries without labels
+    ]
+
+
+def test_exemplars(fake_timer):
+    local_profiler = type(profiler)(exemplars=2)
+    run(local_profiler)
+    local_profiler.swap()
+    run(local_profiler)
+    assert [(c['path'], c['duration']) for c in local_profiler.slow_calls()] == [
+        ('request', pytest.approx(8.)), ('request/db query', pytest.approx(4.)), ('request/db query', pytest.approx(2.))]
+    for v in local_profiler.root.scopes['request'].scopes['db query'].labels.values():
+        assert v.stat.stat.exemplars is None  # captured once, by the scope
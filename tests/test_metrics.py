@@ -52,4 +52,56 @@ def test_metrics(data, expected):
 
 def test_repr():
     s = Stat()
-    assert repr(s) == '<Stat(avg=None, dev=None, max=None, min=None, num=0, sum=0.0)>'
+    assert repr(s) == '<Stat(avg=None, dev=None, max=None, min=None, num=0, sum=0)>'
+
+
+@pytest.mark.parametrize('data,expected', testdata)
+def test_merge(data, expected):
+    for i in range(len(data) + 1):
+        a = Stat()
+        b = Stat()
+        for v in data[:i]:
+            a.update(v)
+        for v in data[i:]:
+            b.update(v)
+        assert (a + b).stat == expected
+        assert a.merge(b).stat == expected
+
+
+def test_percentiles():
+    s = Stat(histogram=True)
+    for v in range(1, 1001):
+        s.update(v * 1000)
+    st = s.stat
+    assert st['p50'] == pytest.approx(500000, rel=.035)
+    assert st['p90'] == pytest.approx(900000, rel=.035)
+    assert st['p99'] == pytest.approx(990000, rel=.035)
+    assert st['p999'] == pytest.approx(999000, rel=.035)
+    assert s.quantile(0) == pytest.approx(1000, rel=.035)
+    assert s.quantile(1) == pytest.approx(1000000, rel=.035)
+
+
+def test_percentiles_bounded_memory():
+    s = Stat(histogram=True)
+    size = len(s.histogram.counts)
+    for v in (0, 1, 10 ** 9, 10 ** 20, 10 ** 40):
+        s.update(v)
+    assert len(s.histogram.counts) == size
+    assert sum(s.histogram.counts) == 5
+
+
+def test_percentiles_empty():
+    s = Stat(histogram=True)
+    assert s.stat['p50'] is None
+    assert 'p50' not in Stat().stat
+
+
+def test_percentiles_merge():
+    a = Stat(histogram=True)
+    b = Stat(histogram=True)
+    for v in range(1, 501):
+        a.update(v * 1000)
+    for v in range(501, 1001):
+        b.update(v * 1000)
+    assert (a + b).stat['p90'] == pytest.approx(900000, rel=.035)
+    assert (Stat() + a).stat['p90'] == pytest.approx(450000, rel=.035)
@@ -1,9 +1,13 @@
 # coding: U8
 
 
+import pickle
+import random
 import time
+import tracemalloc
 import pytest
 
+import pprofiler
 from pprofiler import profiler
 
 
@@ -20,6 +24,8 @@ def test_contextmanager(fake_timer):
             'name': 'x',
             'num': 10,
             'percent': pytest.approx(100.0),
+            'root_percent': pytest.approx(100.0),
+            'self': pytest.approx(45.),
             'sum': pytest.approx(45.),
         }]
 
@@ -39,6 +45,8 @@ def test_decorator(fake_timer):
             'name': 'x',
             'num': 10,
             'percent': pytest.approx(100.0),
+            'root_percent': pytest.approx(100.0),
+            'self': pytest.approx(45.),
             'sum': pytest.approx(45.),
         }]
 
@@ -55,9 +63,9 @@ def test_create_and_use_order(fake_timer):
     with c:
         time.sleep(2)
     assert local_profiler.report == [
-        {'avg': pytest.approx(5.), 'dev': None, 'max': pytest.approx(5.), 'min': pytest.approx(5.), 'name': 'a', 'num': 1, 'percent': pytest.approx(50.), 'sum': pytest.approx(5.)},
-        {'avg': pytest.approx(3.), 'dev': None, 'max': pytest.approx(3.), 'min': pytest.approx(3.), 'name': 'b', 'num': 1, 'percent': pytest.approx(30.), 'sum': pytest.approx(3.)},
-        {'avg': pytest.approx(2.), 'dev': None, 'max': pytest.approx(2.), 'min': pytest.approx(2.), 'name': 'c', 'num': 1, 'percent': pytest.approx(20.), 'sum': pytest.approx(2.)},
+        {'avg': pytest.approx(5.), 'dev': None, 'max': pytest.approx(5.), 'min': pytest.approx(5.), 'name': 'a', 'num': 1, 'percent': pytest.approx(50.), 'root_percent': pytest.approx(50.), 'self': pytest.approx(5.), 'sum': pytest.approx(5.)},
+        {'avg': pytest.approx(3.), 'dev': None, 'max': pytest.approx(3.), 'min': pytest.approx(3.), 'name': 'b', 'num': 1, 'percent': pytest.approx(30.), 'root_percent': pytest.approx(30.), 'self': pytest.approx(3.), 'sum': pytest.approx(3.)},
+        {'avg': pytest.approx(2.), 'dev': None, 'max': pytest.approx(2.), 'min': pytest.approx(2.), 'name': 'c', 'num': 1, 'percent': pytest.approx(20.), 'root_percent': pytest.approx(20.), 'self': pytest.approx(2.), 'sum': pytest.approx(2.)},
     ]
 
 
@@ -69,8 +77,8 @@ def test_create_and_use_scope(fake_timer):
         with b:
             time.sleep(1)
     assert local_profiler.report == [{
-        'avg': pytest.approx(1.), 'dev': None, 'max': pytest.approx(1.), 'min': pytest.approx(1.), 'name': 'a', 'num': 1, 'percent': 100., 'sum': pytest.approx(1.), '~': [{
-        'avg': pytest.approx(1.), 'dev': None, 'max': pytest.approx(1.), 'min': pytest.approx(1.), 'name': 'b', 'num': 1, 'percent': 100., 'sum': pytest.approx(1.)}],
+        'avg': pytest.approx(1.), 'dev': None, 'max': pytest.approx(1.), 'min': pytest.approx(1.), 'name': 'a', 'num': 1, 'percent': 100., 'root_percent': 100., 'self': pytest.approx(0.), 'sum': pytest.approx(1.), '~': [{
+        'avg': pytest.approx(1.), 'dev': None, 'max': pytest.approx(1.), 'min': pytest.approx(1.), 'name': 'b', 'num': 1, 'percent': 100., 'root_percent': 100., 'self': pytest.approx(1.), 'sum': pytest.approx(1.)}],
     }]
 
 
@@ -96,8 +104,8 @@ def test_report_deep_not_complete(fake_timer):
             with local_profiler('c'):
                 incomplete = local_profiler.report
     assert incomplete == [{
-        'sum': pytest.approx(1.), 'num': 1, 'avg': pytest.approx(1.), 'dev': None, 'min': pytest.approx(1.), 'max': pytest.approx(1.), 'percent': pytest.approx(100.0), 'name': 'a', '~': [{
-        'sum': pytest.approx(1.), 'num': 1, 'avg': pytest.approx(1.), 'dev': None, 'min': pytest.approx(1.), 'max': pytest.approx(1.), 'percent': pytest.approx(100.0), 'name': 'b'}],
+        'sum': pytest.approx(1.), 'num': 1, 'avg': pytest.approx(1.), 'dev': None, 'min': pytest.approx(1.), 'max': pytest.approx(1.), 'percent': pytest.approx(100.0), 'root_percent': pytest.approx(100.0), 'self': pytest.approx(0.), 'name': 'a', '~': [{
+        'sum': pytest.approx(1.), 'num': 1, 'avg': pytest.approx(1.), 'dev': None, 'min': pytest.approx(1.), 'max': pytest.approx(1.), 'percent': pytest.approx(100.0), 'root_percent': pytest.approx(100.0), 'self': pytest.approx(1.), 'name': 'b'}],
     }]
 
 
@@ -109,8 +117,8 @@ def test_report_deep_not_complete_inverted(fake_timer):
     with local_profiler('a'):
         incomplete = local_profiler.report
     assert incomplete == [{
-        'sum': pytest.approx(1.), 'num': 1, 'avg': pytest.approx(1.), 'dev': None, 'min': pytest.approx(1.), 'max': pytest.approx(1.), 'percent': pytest.approx(100.0), 'name': 'a', '~': [{
-        'sum': pytest.approx(1.), 'num': 1, 'avg': pytest.approx(1.), 'dev': None, 'min': pytest.approx(1.), 'max': pytest.approx(1.), 'percent': pytest.approx(100.0), 'name': 'b'}],
+        'sum': pytest.approx(1.), 'num': 1, 'avg': pytest.approx(1.), 'dev': None, 'min': pytest.approx(1.), 'max': pytest.approx(1.), 'percent': pytest.approx(100.0), 'root_percent': pytest.approx(100.0), 'self': pytest.approx(0.), 'name': 'a', '~': [{
+        'sum': pytest.approx(1.), 'num': 1, 'avg': pytest.approx(1.), 'dev': None, 'min': pytest.approx(1.), 'max': pytest.approx(1.), 'percent': pytest.approx(100.0), 'root_percent': pytest.approx(100.0), 'self': pytest.approx(1.), 'name': 'b'}],
     }]
 
 
@@ -122,8 +130,8 @@ def test_report_deep_not_complete_topmost(fake_timer):
         with local_profiler('b'):
             incomplete = local_profiler.report
     assert incomplete == [{
-        'sum': pytest.approx(0.0), 'num': 0, 'avg': None, 'dev': None, 'min': None, 'max': None, 'name': 'a', 'percent': pytest.approx(0.0), '~': [{
-        'sum': pytest.approx(1.0), 'num': 1, 'avg': pytest.approx(1.0), 'dev': None, 'min': pytest.approx(1.0), 'max': pytest.approx(1.0), 'name': 'b', 'percent': pytest.approx(100.0)}],
+        'sum': pytest.approx(0.0), 'num': 0, 'avg': None, 'dev': None, 'min': None, 'max': None, 'name': 'a', 'percent': pytest.approx(0.0), 'root_percent': pytest.approx(0.0), 'self': pytest.approx(0.0), '~': [{
+        'sum': pytest.approx(1.0), 'num': 1, 'avg': pytest.approx(1.0), 'dev': None, 'min': pytest.approx(1.0), 'max': pytest.approx(1.0), 'name': 'b', 'percent': pytest.approx(100.0), 'root_percent': pytest.approx(0.0), 'self': pytest.approx(1.0)}],
     }]
 
 
@@ -136,3 +144,392 @@ def test_no_data_in_scope():
 def test_empty():
     local_profiler = type(profiler)()
     assert local_profiler.report == []
+
+
+def worker_profiler(t):
+    local_profiler = type(profiler)()
+    with local_profiler('a'):
+        with local_profiler('b'):
+            time.sleep(t)
+    with local_profiler('c%d' % t):
+        time.sleep(1)
+    return local_profiler
+
+
+def test_merge(fake_timer):
+    workers = [worker_profiler(t) for t in (1, 2, 3)]
+    merged = type(profiler)().merge(*workers)
+    assert [(r['name'], r['level'], r['num'], r['sum'], r['min'], r['max']) for r in merged] == [
+        ('a', 0, 3, pytest.approx(6.), pytest.approx(1.), pytest.approx(3.)),
+        ('b', 1, 3, pytest.approx(6.), pytest.approx(1.), pytest.approx(3.)),
+        ('c1', 0, 1, pytest.approx(1.), pytest.approx(1.), pytest.approx(1.)),
+        ('c2', 0, 1, pytest.approx(1.), pytest.approx(1.), pytest.approx(1.)),
+        ('c3', 0, 1, pytest.approx(1.), pytest.approx(1.), pytest.approx(1.)),
+    ]
+    assert merged.report[0]['dev'] == pytest.approx(1.)
+    assert [r['num'] for r in workers[0]] == [1, 1, 1]  # sources are untouched
+
+
+def test_sum(fake_timer):
+    workers = [worker_profiler(t) for t in (1, 2)]
+    assert sum(workers).report == (workers[0] + workers[1]).report == type(profiler)().merge(*workers).report
+    total = type(profiler)()
+    root = total.root
+    for w in workers:
+        total += w
+    assert total.root is root  # merged in place
+    assert total.report == sum(workers).report
+
+
+def test_dumps_loads(fake_timer):
+    worker = worker_profiler(2)
+    with worker('a'):
+        with worker('open'):
+            data = worker.dumps()
+    assert isinstance(data, bytes)
+    assert type(profiler).loads(data).report == worker_profiler(2).report
+
+
+def test_merge_bytes(fake_timer):
+    workers = [worker_profiler(t) for t in (1, 2, 3)]
+    merged = type(profiler)()
+    for w in workers:
+        merged.merge_bytes(memoryview(bytearray(w.dumps())))
+    assert merged.report == type(profiler)().merge(*workers).report
+
+
+def test_dumps_smaller_than_pickle(fake_timer):
+    local_profiler = type(profiler)()
+    for i in range(100):
+        with local_profiler('scope'):
+            with local_profiler('subscope %d' % i):
+                time.sleep(1)
+    assert len(local_profiler.dumps()) < len(pickle.dumps(local_profiler))
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'XXXX\x01\x00\x00\x00\x00\x00\x00\x00\x00',
+    b'PPRF\xff\x00\x00\x00\x00\x00\x00\x00\x00',
+    b'PPRF\x01\x01\x00\x00\x00\x00\x00\x00\x00',
+])
+def test_loads_broken(data):
+    with pytest.raises(ValueError):
+        type(profiler).loads(data)
+
+
+def test_dumps_percentiles(fake_timer):
+    local_profiler = type(profiler)(percentiles=True)
+    for t in range(1, 11):
+        with local_profiler('x'):
+            time.sleep(t)
+    restored = type(profiler).loads(local_profiler.dumps())
+    assert restored.report == local_profiler.report
+    assert restored.report[0]['p90'] == pytest.approx(9, rel=.03)
+
+
+def test_sample_every_nth(fake_timer):
+    local_profiler = type(profiler)(sample=10)
+    for t in range(100):
+        with local_profiler('x'):
+            time.sleep(1)
+    assert local_profiler.report == [{
+        'avg': pytest.approx(1.), 'dev': pytest.approx(0.), 'max': pytest.approx(1.), 'min': pytest.approx(1.), 'name': 'x',
+        'num': 100, 'percent': pytest.approx(100.), 'root_percent': pytest.approx(100.), 'self': pytest.approx(100.), 'sum': pytest.approx(100.), 'estimated': True,
+    }]
+    stat = local_profiler.root.scopes['x'].stat
+    assert (stat.n, stat.skipped) == (10, 90)
+
+
+def test_sample_per_scope(fake_timer):
+    local_profiler = type(profiler)()
+    for t in range(10):
+        with local_profiler('hot', sample=5):
+            with local_profiler('cold'):
+                time.sleep(1)
+    assert [(r['name'], r['num'], r['sum'], r.get('estimated', False)) for r in local_profiler] == [
+        ('hot', 10, pytest.approx(10.), True),
+        ('cold', 10, pytest.approx(10.), False),
+    ]
+
+
+def test_sample_probability(fake_timer, monkeypatch):
+    values = iter([.1, .9] * 50)
+    monkeypatch.setattr(random, 'random', lambda: next(values))
+    local_profiler = type(profiler)(sample=.5)
+    for t in range(100):
+        with local_profiler('x'):
+            time.sleep(1)
+    stat = local_profiler.root.scopes['x'].stat
+    assert (stat.n, stat.skipped) == (50, 50)
+    assert type(profiler).loads(local_profiler.dumps()).report == local_profiler.report
+
+
+@pytest.mark.parametrize('sample', [0, -1, 0., 1., 1.5, True, '2'])
+def test_bad_sample(sample):
+    with pytest.raises(ValueError):
+        type(profiler)(sample=sample)
+    with pytest.raises(ValueError):
+        type(profiler)()('x', sample=sample)
+    with pytest.raises(ValueError):
+        pprofiler.ThreadProfiler(sample=sample)
+
+
+def test_calibrate():
+    local_profiler = type(profiler)()
+    with local_profiler('x'):
+        inner, outer = local_profiler.calibrate(n=100, repeat=2)
+    assert 0 <= inner <= outer
+    assert local_profiler.calibration == (inner, outer)
+    assert [r['name'] for r in local_profiler] == ['x']
+
+
+def test_compensate(fake_timer):
+    local_profiler = type(profiler)()
+    with local_profiler('a'):
+        time.sleep(1)
+        for t in range(10):
+            with local_profiler('b'):
+                time.sleep(1)
+    local_profiler.calibration = (.01e9, .02e9)  # ticks
+    assert [(r['name'], r['sum'], r['min']) for r in local_profiler] == [
+        ('a', pytest.approx(11.), pytest.approx(11.)),
+        ('b', pytest.approx(10.), pytest.approx(1.)),
+    ]
+    local_profiler.compensate = True
+    assert [(r['name'], r['sum'], r['min'], r['dev']) for r in local_profiler] == [
+        ('a', pytest.approx(11. - .01 - 10 * .02), pytest.approx(11. - .01), None),
+        ('b', pytest.approx(10. - 10 * .01), pytest.approx(1. - .01), pytest.approx(0., abs=1e-6)),
+    ]
+
+
+def test_compensate_constant():
+    s = pprofiler.Stat()
+    for _ in range(10):
+        s.update(1000000456)
+    assert pprofiler.compensate_stat(s, 0, 600.5, 1972.4).stat['dev'] == 0.  # no math domain error
+
+
+def test_swap(fake_timer):
+    local_profiler = type(profiler)()
+    with local_profiler('a'):
+        with local_profiler('b'):
+            time.sleep(1)
+        with local_profiler('c'):
+            first = local_profiler.swap()
+            time.sleep(2)
+        with local_profiler('b'):
+            time.sleep(3)
+        assert local_profiler.is_complete is False
+    second = local_profiler.swap()
+    assert [(r['name'], r['level'], r['num'], r['sum']) for r in first] == [
+        ('a', 0, 0, 0.),
+        ('b', 1, 1, pytest.approx(1.)),
+    ]
+    assert [(r['name'], r['level'], r['num'], r['sum']) for r in second] == [
+        ('a', 0, 1, pytest.approx(6.)),
+        ('b', 1, 1, pytest.approx(3.)),
+        ('c', 1, 1, pytest.approx(2.)),
+    ]
+    assert local_profiler.report == []
+    assert (first + second).report == worker_profiler_swap_total()
+
+
+def worker_profiler_swap_total():
+    local_profiler = type(profiler)()
+    with local_profiler('a'):
+        with local_profiler('b'):
+            time.sleep(1)
+        with local_profiler('c'):
+            time.sleep(2)
+        with local_profiler('b'):
+            time.sleep(3)
+    return local_profiler.report
+
+
+def test_snapshot_delta(fake_timer):
+    local_profiler = type(profiler)(percentiles=True)
+    for t in (5, 6):
+        with local_profiler('x'):
+            time.sleep(t)
+    earlier = local_profiler.snapshot()
+    for t in (1, 2, 3):
+        with local_profiler('x'):
+            time.sleep(t)
+        with local_profiler('y'):
+            time.sleep(t)
+    later = local_profiler.snapshot()
+    delta = later - earlier
+    assert [(r['name'], r['num'], r['sum'], r['min'], r['max']) for r in delta] == [
+        ('x', 3, pytest.approx(6.), pytest.approx(1.), pytest.approx(6.)),  # max is a bound
+        ('y', 3, pytest.approx(6.), pytest.approx(1.), pytest.approx(3.)),
+    ]
+    assert delta.report[0]['p50'] == pytest.approx(2., rel=.035)
+    assert (later - later).report == []
+
+
+def test_windows(fake_timer):
+    local_profiler = type(profiler)(windows=(60, 5))  # the last 5 minutes by minute
+    for t in range(1, 11):  # minute by minute
+        with local_profiler('x'):
+            time.sleep(t)
+        time.sleep(60 - t)
+    with local_profiler('y'):
+        time.sleep(1)
+    assert [(r['name'], r['num'], r['sum']) for r in local_profiler.window(60)] == [('y', 1, pytest.approx(1.))]
+    assert [(r['name'], r['num'], r['sum'], r['min'], r['max']) for r in local_profiler.window(180)] == [
+        ('x', 2, pytest.approx(19.), pytest.approx(9.), pytest.approx(10.)),
+        ('y', 1, pytest.approx(1.), pytest.approx(1.), pytest.approx(1.)),
+    ]
+    assert [(r['name'], r['num']) for r in local_profiler.window(3600)] == [('x', 4), ('y', 1)]  # no more than 5 buckets
+    assert [(r['name'], r['num']) for r in local_profiler] == [('x', 10), ('y', 1)]
+
+
+def test_windows_swap_merge(fake_timer):
+    local_profiler = type(profiler)(windows=(60, 5))
+    for _ in range(3):
+        with local_profiler('x', kind='a'):
+            time.sleep(1)
+    assert [(r['name'], r['num']) for r in local_profiler.swap()] == [('x', 3)]
+    with local_profiler('y'):
+        time.sleep(1)
+    assert [(r['name'], r['num']) for r in local_profiler.window(60)] == [('x', 3), ('y', 1)]  # swap() keeps windows
+    window = local_profiler.window(60)
+    window.by_labels = True
+    assert [(r['name'], r['num']) for r in window] == [('x', 3), ('[kind=a]', 3), ('y', 1)]
+    other = type(profiler)()
+    with other('z', kind='b'):
+        time.sleep(1)
+    local_profiler.merge(other)
+    window = local_profiler.window(60)
+    window.by_labels = True
+    assert [(r['name'], r['num']) for r in window] == [('x', 3), ('[kind=a]', 3), ('y', 1)]  # merged stats have no time
+
+
+def test_windows_not_enabled():
+    with pytest.raises(RuntimeError):
+        type(profiler)().window(60)
+
+
+def test_clocks(fake_timer):
+    local_profiler = type(profiler)(clocks=('cpu',), windows=(60, 5))
+    for _ in range(2):
+        with local_profiler('io'):
+            fake_timer.work(1)
+            time.sleep(3)
+    with local_profiler('calc'):
+        fake_timer.work(2)
+    assert [(r['name'], r['sum'], r['cpu'], r['cpu%']) for r in local_profiler] == [
+        ('io', pytest.approx(8.), pytest.approx(2.), pytest.approx(25.)),
+        ('calc', pytest.approx(2.), pytest.approx(2.), pytest.approx(100.)),
+    ]
+    assert [(r['name'], r['cpu']) for r in local_profiler.window(60)] == [('io', pytest.approx(2.)), ('calc', pytest.approx(2.))]
+    restored = type(profiler).loads(local_profiler.dumps())
+    assert list(restored) == list(local_profiler)
+    with local_profiler('calc'):
+        fake_timer.work(1)
+    assert [(r['name'], r['cpu']) for r in local_profiler - restored] == [('calc', pytest.approx(1.))]
+
+
+def test_unknown_clock():
+    with pytest.raises(ValueError):
+        type(profiler)(clocks=('gpu',))
+
+
+def test_memory_old_python(monkeypatch):
+    monkeypatch.delattr(tracemalloc, 'reset_peak')  # Python 3.8
+    with pytest.raises(RuntimeError):
+        type(profiler)(memory=True)
+
+
+def test_memory():
+    local_profiler = type(profiler)(memory=True)
+    kept = []
+    try:
+        with local_profiler('outer'):
+            garbage = bytearray(3000000)  # the peak of the outer scope, before nested scopes reset the peak
+            del garbage
+            with local_profiler('keep'):
+                kept.append(bytearray(1000000))
+            with local_profiler('temp'):
+                garbage = bytearray(1500000)
+                del garbage
+    finally:
+        tracemalloc.stop()
+    rows = {r['name']: (r['alloc'], r['peak']) for r in local_profiler}  # rows are ordered by time, it is not fixed here
+    assert rows == {
+        'outer': (pytest.approx(1000000, abs=10000), pytest.approx(3000000, abs=10000)),
+        'keep': (pytest.approx(1000000, abs=10000), pytest.approx(1000000, abs=10000)),
+        'temp': (pytest.approx(0, abs=10000), pytest.approx(1500000, abs=10000)),
+    }
+
+
+def test_max_children(fake_timer):
+    local_profiler = type(profiler)(max_children=2)
+    with local_profiler('request'):
+        for i in range(5):
+            with local_profiler('user {}'.format(i)):
+                time.sleep(1)
+        with local_profiler('user 0'):
+            time.sleep(1)
+    assert [(r['name'], r['level'], r['num']) for r in local_profiler] == [
+        ('request', 0, 1),
+        ('<other>', 1, 3),
+        ('user 0', 1, 2),
+        ('user 1', 1, 1),
+    ]
+    assert local_profiler.dropped == 3
+
+
+def test_max_scopes(fake_timer):
+    local_profiler = type(profiler)(max_scopes=3)
+    for name in 'abcde':
+        with local_profiler(name):
+            with local_profiler('x'):
+                time.sleep(1)
+    assert [(r['name'], r['level'], r['num']) for r in local_profiler] == [
+        ('<other>', 0, 3),  # 'c', 'd', 'e'
+        ('<other>', 1, 3),  # 'x' in them
+        ('a', 0, 1),
+        ('x', 1, 1),
+        ('b', 0, 1),
+        ('<other>', 1, 1),
+    ]
+    assert local_profiler.dropped == 7  # every entry of a name that did not fit is counted
+
+
+@pytest.mark.parametrize('limits', [{'max_children': 0}, {'max_scopes': 2}])
+def test_calibrate_with_limits(limits):
+    local_profiler = type(profiler)(**limits)
+    local_profiler.calibrate(n=10, repeat=5)
+    assert local_profiler.root.scopes == {}
+    assert (local_profiler.scopes_number, local_profiler.dropped) == (0, 0)
+
+
+def test_exemplars_top(fake_timer):
+    local_profiler = type(profiler)(exemplars=3)
+    for t in (5, 1, 7, 2, 9, 3):
+        with local_profiler('x'):
+            time.sleep(t)
+    calls = local_profiler.slow_calls()
+    assert [(c['path'], c['duration']) for c in calls] == [('x', pytest.approx(9.)), ('x', pytest.approx(7.)), ('x', pytest.approx(5.))]
+    assert calls[0]['time'] == pytest.approx(1000. + 5 + 1 + 7 + 2 + 9)
+    assert any('test_exemplars_top' in frame for frame in calls[0]['context'])  # a stack of the caller
+    stat = local_profiler.root.scopes['x'].stat
+    assert stat.exemplars.bar == 5 * 10 ** 9  # faster entries are not captured at all
+
+
+def test_exemplars_threshold(fake_timer):
+    context = iter(range(100))
+    local_profiler = type(profiler)(exemplars=10, slow={'db': 2, None: 5}, context=lambda: next(context))
+    with local_profiler('request'):
+        for t in (1, 3, 4):
+            with local_profiler('db'):
+                time.sleep(t)
+    assert [(c['path'], c['duration'], c['context']) for c in local_profiler.slow_calls()] == [
+        ('request', pytest.approx(8.), 2),
+        ('request/db', pytest.approx(4.), 1),
+        ('request/db', pytest.approx(3.), 0),
+    ]
+    merged = type(profiler)().merge(local_profiler, local_profiler)
+    assert [c['context'] for c in merged.slow_calls()] == [2, 2, 1, 1, 0, 0]
@@ -3,7 +3,9 @@
 
 import time
 
-from pprofiler import profiler
+import pytest
+
+from pprofiler import profiler, report_to_flat
 
 
 def test_print_to_stdout(fake_timer, fake_out):
@@ -59,9 +61,210 @@ def test_order_and_multi_back(fake_timer, fake_logger):
     for x in fake_logger.lines():
         print(repr(x))
     assert fake_logger.lines() == [
-        'name      perc   sum  n   avg   max   min dev',
-        '-------- ----- ----- -- ----- ----- ----- ---',
-        'p ......   75%  3.00  1  3.00  3.00  3.00   -',
-        '. a ....  100%  3.00  1  3.00  3.00  3.00   -',
-        '. . b ..  100%  3.00  1  3.00  3.00  3.00   -',
-        'q ......   25%  1.00  1  1.00  1.00  1.00   -']
+        'name      perc root%   sum  self  n   avg   max   min dev',
+        '-------- ----- ----- ----- ----- -- ----- ----- ----- ---',
+        'p ......   75%   75%  3.00  0.00  1  3.00  3.00  3.00   -',
+        '. a ....  100%   75%  3.00  0.00  1  3.00  3.00  3.00   -',
+        '. . b ..  100%   75%  3.00  3.00  1  3.00  3.00  3.00   -',
+        'q ......   25%   25%  1.00  1.00  1  1.00  1.00  1.00   -']
+
+
+def test_percentiles(fake_timer, fake_logger):
+    local_profiler = type(profiler)(percentiles=True)
+    with local_profiler('p'):
+        for t in range(1, 11):
+            with local_profiler('x'):
+                time.sleep(t)
+    local_profiler.print_report(fake_logger)
+    assert fake_logger.lines() == [
+        'name    perc root%    sum   self   n    avg    max    min   dev    p50    p90    p99   p999',
+        '------ ----- ----- ------ ------ --- ------ ------ ------ ----- ------ ------ ------ ------',
+        'p ....  100%  100%  55.00   0.00   1  55.00  55.00  55.00     -  55.00  55.00  55.00  55.00',
+        '. x ..  100%  100%  55.00  55.00  10   5.50  10.00   1.00  3.03   4.97   8.86   9.93   9.93']
+
+
+def test_unaccounted(fake_timer, fake_logger):
+    local_profiler = type(profiler)()
+    local_profiler.unaccounted = True
+    for _ in range(2):
+        with local_profiler('q'):
+            time.sleep(1)
+    with local_profiler('q'):
+        with local_profiler('r'):
+            time.sleep(1)
+        time.sleep(2)
+    with local_profiler('s'):
+        time.sleep(5)
+    local_profiler.print_report(fake_logger)
+    assert fake_logger.lines() == [
+        'name               perc root%   sum  self  n   avg   max   min   dev',
+        '------------------ ---- ----- ----- ----- -- ----- ----- ----- -----',
+        'q ................  50%   50%  5.00  4.00  3  1.67  3.00  1.00  1.15',
+        '. <unaccounted> ..  80%   40%  4.00  4.00  3  1.33     -     -     -',
+        '. r ..............  20%   10%  1.00  1.00  1  1.00  1.00  1.00     -',
+        's ................  50%   50%  5.00  5.00  1  5.00  5.00  5.00     -']
+    assert [(r['name'], r['self']) for r in type(profiler)().merge(local_profiler)] == [('q', pytest.approx(4.)), ('r', pytest.approx(1.)), ('s', pytest.approx(5.))]
+
+
+def test_estimated(fake_timer, fake_logger):
+    local_profiler = type(profiler)(sample=2)
+    for t in range(4):
+        with local_profiler('x'):
+            time.sleep(1)
+    local_profiler.print_report(fake_logger)
+    assert fake_logger.lines() == [
+        'name  perc    sum   n   avg   max   min   dev',
+        '---- ----- ------ --- ----- ----- ----- -----',
+        'x ..  100%  ~4.00  ~4  1.00  1.00  1.00  0.00']
+
+
+def test_clocks(fake_timer, fake_logger):
+    local_profiler = type(profiler)(clocks=('cpu',))
+    with local_profiler('x'):
+        fake_timer.work(1)
+        time.sleep(3)
+    local_profiler.print_report(fake_logger)
+    assert fake_logger.lines() == [
+        'name  perc   sum  n   avg   max   min dev   cpu cpu%',
+        '---- ----- ----- -- ----- ----- ----- --- ----- ----',
+        'x ..  100%  4.00  1  4.00  4.00  4.00   -  1.00  25%']
+
+
+def test_calibration(fake_timer, fake_logger):
+    local_profiler = type(profiler)()
+    with local_profiler('x'):
+        time.sleep(1)
+    local_profiler.calibration = (100, 300)
+    local_profiler.print_report(fake_logger)
+    assert fake_logger.lines() == [
+        'name  perc   sum  n   avg   max   min dev',
+        '---- ----- ----- -- ----- ----- ----- ---',
+        'x ..  100%  1.00  1  1.00  1.00  1.00   -',
+        'calibration: 300ns per scope, 100ns inside it (not compensated)']
+
+
+def test_deep_tree(fake_timer):
+    local_profiler = type(profiler)()
+    timers = [local_profiler('level %d' % i) for i in range(5000)]
+    for t in timers:
+        t.__enter__()
+    time.sleep(1)
+    for t in reversed(timers):
+        t.__exit__(None, None, None)
+    rows = list(local_profiler)
+    assert [r['level'] for r in rows] == list(range(5000))
+    report = local_profiler.report
+    assert report[0]['name'] == 'level 0'
+    assert len(list(report_to_flat(report))) == 5000
+
+
+def test_report_to_flat_does_not_mutate(fake_timer):
+    local_profiler = type(profiler)()
+    with local_profiler('a'):
+        with local_profiler('b'):
+            time.sleep(1)
+    report = local_profiler.report
+    assert [(r['name'], r['level']) for r in report_to_flat(report)] == [('a', 0), ('b', 1)]
+    assert report == local_profiler.report
+    assert [(r['name'], r['level']) for r in report_to_flat(report)] == [('a', 0), ('b', 1)]
+
+
+def test_top(fake_timer):
+    local_profiler = type(profiler)()
+    for t in range(1, 6):
+        with local_profiler('x%d' % t):
+            for u in range(1, 4):
+                with local_profiler('y%d' % u):
+                    time.sleep(t * u)
+    assert [(r['name'], r['level']) for r in local_profiler.iter_report(top=2)] == [
+        ('x5', 0), ('y3', 1), ('y2', 1),
+        ('x4', 0), ('y3', 1), ('y2', 1),
+    ]
+    assert [r['percent'] for r in local_profiler.iter_report(top=1)] == [pytest.approx(100 * 5 / 15.), pytest.approx(50.)]
+
+
+def test_open_scopes_without_data(fake_timer):
+    local_profiler = type(profiler)()
+    with local_profiler('a'):
+        with local_profiler('b'):
+            with local_profiler('c'):
+                pass
+        with local_profiler('d'):
+            with local_profiler('e'):
+                assert [(r['name'], r['level']) for r in local_profiler] == [('a', 0), ('b', 1), ('c', 2)]  # no d and e
+
+
+@pytest.mark.parametrize('weight, lines', [
+    ('self', ['a 1000000000', 'a;b 2000000000', 'a;b;c 3000000000', 'd:e 1000000000']),
+    ('total', ['a 6000000000', 'a;b 5000000000', 'a;b;c 3000000000', 'd:e 1000000000']),
+    ('count', ['a 1', 'a;b 1', 'a;b;c 3', 'd:e 1']),
+])
+def test_folded(fake_timer, weight, lines):
+    local_profiler = type(profiler)()
+    with local_profiler('a'):
+        time.sleep(1)
+        with local_profiler('b'):
+            time.sleep(2)
+            for _ in range(3):
+                with local_profiler('c'):
+                    time.sleep(1)
+    with local_profiler('d;e'):
+        time.sleep(1)
+    assert sorted(local_profiler.folded(weight)) == lines
+
+
+def test_folded_deep_tree(fake_timer):
+    local_profiler = type(profiler)()
+    timers = [local_profiler(str(i % 10)) for i in range(5000)]
+    for t in timers:
+        t.__enter__()
+    time.sleep(1)
+    for t in reversed(timers):
+        t.__exit__(None, None, None)
+    lines = list(local_profiler.folded())
+    assert len(lines) == 1  # the only scope with self time
+    assert lines[0].endswith(';9 1000000000')
+    assert lines[0].count(';') == 4999
+
+
+def test_name_report(fake_timer):
+    local_profiler = type(profiler)()
+    with local_profiler('main'):
+        for _ in range(2):
+            with local_profiler('db'):
+                time.sleep(1)
+        with local_profiler('render'):
+            time.sleep(1)
+            with local_profiler('db'):
+                time.sleep(3)
+    with local_profiler('db'):
+        time.sleep(1)
+    assert [(r['name'], r['num'], r['sum'], r['self'], [(c['name'], c['num']) for c in r['callers']], [(c['name'], c['num']) for c in r['callees']])
+            for r in local_profiler.name_report] == [
+        ('main', 1, pytest.approx(6.), pytest.approx(0.), [], [('render', 1), ('db', 2)]),
+        ('db', 4, pytest.approx(6.), pytest.approx(6.), [('render', 1), ('main', 2)], []),
+        ('render', 1, pytest.approx(4.), pytest.approx(1.), [('main', 1)], [('db', 1)]),
+    ]
+    assert list(local_profiler.name_lines) == [
+        'name             sum  self  n   avg   max   min',
+        '-------------- ----- ----- -- ----- ----- -----',
+        'main .........  6.00  0.00  1  6.00  6.00  6.00',
+        '  -> render ..  4.00        1  4.00  4.00  4.00',
+        '  -> db ......  2.00        2  1.00  1.00  1.00',
+        'db ...........  6.00  6.00  4  1.50  3.00  1.00',
+        '  <- render ..  3.00        1  3.00  3.00  3.00',
+        '  <- main ....  2.00        2  1.00  1.00  1.00',
+        'render .......  4.00  1.00  1  4.00  4.00  4.00',
+        '  <- main ....  4.00        1  4.00  4.00  4.00',
+        '  -> db ......  3.00        1  3.00  3.00  3.00']
+
+
+def test_name_report_recursion(fake_timer):
+    local_profiler = type(profiler)()
+    with local_profiler('r'):
+        time.sleep(1)
+        with local_profiler('r'):
+            time.sleep(2)
+    r, = local_profiler.name_report
+    assert (r['num'], r['sum'], r['self']) == (1, pytest.approx(3.), pytest.approx(3.))  # the nested entry is not counted twice
+    assert [(c['name'], c['num'], c['sum']) for c in r['callees']] == [('r', 1, pytest.approx(2.))]
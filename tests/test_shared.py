@@ -0,0 +1,93 @@
+# coding: U8
+
+
+import multiprocessing
+
+import pytest
+
+from pprofiler import SharedStats, OTHER_SCOPE, SHARED_NAME_SIZE
+
+
+def worker(shared, n):
+    local_profiler = shared.profiler()
+    for _ in range(n):
+        with local_profiler('a'):
+            with local_profiler('b'):
+                pass
+        with local_profiler('c'):
+            pass
+
+
+def waiting_worker(shared, ready, done):
+    local_profiler = shared.profiler()
+    with local_profiler('running'):
+        for _ in range(3):
+            with local_profiler('x'):
+                pass
+        ready.set()
+        done.wait()
+
+
+def test_shared_merged():
+    with SharedStats(3, slots=16) as shared:
+        processes = [multiprocessing.Process(target=worker, args=(shared, n)) for n in (1, 2, 3)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        assert sorted((r['name'], r['level'], r['num']) for r in shared.snapshot()) == [('a', 0, 6), ('b', 1, 6), ('c', 0, 6)]
+        assert sorted((r['name'], r['num']) for r in shared.snapshot(0) if r['level'] == 0) in ([('a', n), ('c', n)] for n in (1, 2, 3))
+
+
+def test_shared_live():
+    with SharedStats(1) as shared:
+        ready = multiprocessing.Event()
+        done = multiprocessing.Event()
+        p = multiprocessing.Process(target=waiting_worker, args=(shared, ready, done))
+        p.start()
+        try:
+            assert ready.wait(10)
+            assert [(r['name'], r['num']) for r in shared.snapshot()] == [('running', 0), ('x', 3)]  # running is not complete
+        finally:
+            done.set()
+            p.join()
+        assert [(r['name'], r['num']) for r in shared.snapshot()] == [('running', 1), ('x', 3)]
+
+
+def test_shared_in_process(fake_timer):
+    with SharedStats(1, slots=3) as shared:
+        local_profiler = shared.profiler()
+        for name in ('a', 'b', 'c', 'd', 'e', 'a'):
+            with local_profiler(name):
+                pass
+        with local_profiler('a'):
+            with local_profiler('f'):
+                pass
+        assert local_profiler.dropped == 3
+        assert [(r['name'], r['level'], r['num']) for r in local_profiler] == [
+            ('a', 0, 3), (OTHER_SCOPE, 1, 1), ('b', 0, 1), ('c', 0, 1), (OTHER_SCOPE, 0, 2)]
+        assert [(r['name'], r['level'], r['num']) for r in shared.snapshot()] == [('a', 0, 3), ('b', 0, 1), ('c', 0, 1)]  # <other> is local
+        with pytest.raises(RuntimeError):
+            shared.profiler()
+        with pytest.raises(RuntimeError):
+            local_profiler.swap()
+
+
+def test_shared_long_names(fake_timer):
+    with SharedStats(1) as shared:
+        local_profiler = shared.profiler()
+        long_name = 'x' * SHARED_NAME_SIZE
+        for _ in range(3):
+            with local_profiler(long_name + 'a'):
+                pass
+        with local_profiler(long_name + 'b'):  # the same truncated name, the same slot
+            pass
+        assert [(r['name'], r['num']) for r in shared.snapshot()] == [(long_name, 4)]
+        assert [(r['name'], r['num']) for r in local_profiler] == [(long_name, 4)]  # one scope locally too
+
+
+def test_shared_calibrate():
+    with SharedStats(1) as shared:
+        local_profiler = shared.profiler()
+        local_profiler.calibrate(n=10, repeat=2)
+        assert list(shared.snapshot()) == []
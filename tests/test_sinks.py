@@ -0,0 +1,57 @@
+# coding: U8
+
+
+import io
+import json
+import sqlite3
+import time
+
+import pytest
+
+from pprofiler import profiler, SQLiteSink, CSVSink, JSONLinesSink
+
+
+def sample_profiler():
+    local_profiler = type(profiler)()
+    with local_profiler('a'):
+        with local_profiler('b'):
+            time.sleep(1)
+    with local_profiler('c'):
+        time.sleep(1)
+    return local_profiler
+
+
+def test_sqlite(fake_timer):
+    connection = sqlite3.connect(':memory:')
+    with SQLiteSink(connection, run='r1', batch=2) as sink:
+        sink.add(sample_profiler())
+        assert connection.execute('SELECT COUNT(*) FROM pprofiler').fetchone() == (2,)  # one batch
+    assert connection.execute('SELECT run, time, path, level, name, num, sum FROM pprofiler').fetchall() == [
+        ('r1', 1002., 'a', 0, 'a', 1, 1.),
+        ('r1', 1002., 'a/b', 1, 'b', 1, 1.),
+        ('r1', 1002., 'c', 0, 'c', 1, 1.),
+    ]
+
+
+def test_csv(fake_timer):
+    stream = io.StringIO()
+    sink = CSVSink(stream, run='r1', interval=0)
+    sink.add(sample_profiler(), timestamp=5)
+    assert stream.getvalue().splitlines() == [
+        'run,time,path,level,name,num,sum,avg,dev,min,max,percent',
+        'r1,5,a,0,a,1,1.0,1.0,,1.0,1.0,50.0',
+        'r1,5,a/b,1,b,1,1.0,1.0,,1.0,1.0,100.0',
+        'r1,5,c,0,c,1,1.0,1.0,,1.0,1.0,50.0',
+    ]
+
+
+def test_json_lines(fake_timer):
+    stream = io.StringIO()
+    with JSONLinesSink(stream) as sink:
+        sink.add(sample_profiler())
+        sink.add(sample_profiler())
+        assert stream.getvalue() == ''  # waits for batch or interval
+    rows = [json.loads(l) for l in stream.getvalue().splitlines()]
+    assert [(r['path'], r['time']) for r in rows] == [('a', 1002.), ('a/b', 1002.), ('c', 1002.), ('a', 1004.), ('a/b', 1004.), ('c', 1004.)]
+    assert len(set(r['run'] for r in rows)) == 1
+    assert rows[0]['sum'] == pytest.approx(1.)
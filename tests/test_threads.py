@@ -0,0 +1,96 @@
+# coding: U8
+
+
+import time
+import threading
+
+import pytest
+
+from pprofiler import ThreadProfiler
+
+
+def run_interleaved(local_profiler):
+    a_entered = threading.Event()
+    b_done = threading.Event()
+
+    def thread_a():
+        with local_profiler('a'):
+            a_entered.set()
+            b_done.wait()
+            time.sleep(2)
+
+    def thread_b():
+        a_entered.wait()
+        with local_profiler('b'):
+            time.sleep(1)
+        b_done.set()
+
+    threads = [threading.Thread(target=thread_a, name='A'), threading.Thread(target=thread_b, name='B')]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_threads_do_not_nest(fake_timer):
+    local_profiler = ThreadProfiler()
+    run_interleaved(local_profiler)
+    assert local_profiler.is_complete
+    assert local_profiler.report == [
+        {'avg': pytest.approx(3.), 'dev': None, 'max': pytest.approx(3.), 'min': pytest.approx(3.), 'name': 'a', 'num': 1, 'percent': pytest.approx(75.), 'root_percent': pytest.approx(75.), 'self': pytest.approx(3.), 'sum': pytest.approx(3.)},
+        {'avg': pytest.approx(1.), 'dev': None, 'max': pytest.approx(1.), 'min': pytest.approx(1.), 'name': 'b', 'num': 1, 'percent': pytest.approx(25.), 'root_percent': pytest.approx(25.), 'self': pytest.approx(1.), 'sum': pytest.approx(1.)},
+    ]
+
+
+def test_threads_merged(fake_timer):
+    local_profiler = ThreadProfiler()
+    timer = local_profiler('x')  # one Timer shared by all threads, like a decorator
+
+    def worker(t):
+        with timer:
+            time.sleep(t)
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in (1, 2, 3)]
+    for t in threads:
+        t.start()
+        t.join()
+    assert [(r['name'], r['num'], r['sum'], r['min'], r['max']) for r in local_profiler] == [('x', 3, pytest.approx(6.), pytest.approx(1.), pytest.approx(3.))]
+
+
+def test_per_thread(fake_timer):
+    local_profiler = ThreadProfiler()
+    run_interleaved(local_profiler)
+    per_thread = local_profiler.per_thread
+    assert sorted(per_thread) == ['A', 'B']
+    assert [(r['name'], r['sum']) for r in per_thread['A']] == [('a', pytest.approx(3.))]
+    assert [(r['name'], r['sum']) for r in per_thread['B']] == [('b', pytest.approx(1.))]
+
+
+def test_threads_not_complete():
+    local_profiler = ThreadProfiler()
+    with local_profiler('x'):
+        assert local_profiler.is_complete is False
+        assert local_profiler.report == []
+    assert local_profiler.is_complete is True
+
+
+def test_swap(fake_timer):
+    local_profiler = ThreadProfiler()
+    run_interleaved(local_profiler)
+    first = local_profiler.swap()
+    run_interleaved(local_profiler)
+    run_interleaved(local_profiler)
+    second = local_profiler.swap()
+    assert [(r['name'], r['num']) for r in first] == [('a', 1), ('b', 1)]
+    assert [(r['name'], r['num']) for r in second] == [('a', 2), ('b', 2)]
+    assert local_profiler.report == []
+
+
+def test_calibrate():
+    local_profiler = ThreadProfiler(percentiles=True)
+    with local_profiler('x'):
+        pass
+    inner, outer = local_profiler.calibrate(n=100, repeat=2)
+    assert 0 <= inner <= outer
+    assert local_profiler.compensate is True
+    assert [r['name'] for r in local_profiler] == ['x']